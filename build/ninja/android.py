@@ -7,9 +7,132 @@ import subprocess
 
 import toolchain
 
+archnames = {
+  'x86': 'x86',
+  'x86-64': 'x86_64',
+  'arm6': 'arm',
+  'arm7': 'arm',
+  'arm64': 'arm64',
+  'mips': 'mips',
+  'mips64': 'mips64'
+}
+
+archpaths = {
+  'x86': 'x86',
+  'x86-64': 'x86-64',
+  'arm6': 'armeabi',
+  'arm7': 'armeabi-v7a',
+  'arm64': 'arm64-v8a',
+  'mips': 'mips',
+  'mips64': 'mips64'
+}
+
+gcc_toolchainbasenames = {
+  'x86': 'x86-',
+  'x86-64': 'x86_64-',
+  'arm6': 'arm-linux-androideabi-',
+  'arm7': 'arm-linux-androideabi-',
+  'arm64': 'aarch64-linux-android-',
+  'mips': 'mipsel-linux-android-',
+  'mips64': 'mips64el-linux-android-'
+}
+
+gcc_toolchainprefixes = {
+  'x86': 'i686-linux-android-',
+  'x86-64': 'x86_64-linux-android-',
+  'arm6': 'arm-linux-androideabi-',
+  'arm7': 'arm-linux-androideabi-',
+  'arm64': 'aarch64-linux-android-',
+  'mips': 'mipsel-linux-android-',
+  'mips64': 'mips64el-linux-android-'
+}
+
+gcc_toolchainnames = {}
+
+hostarchnames = {}
+
+hostcommands = {}
+
+buildtools = {}
+
 def make_target(toolchain, host, target):
   return Android(toolchain, host, target)
 
+def make_commands(toolchain, host):
+  #Command wrappers only vary with host platform, so the command lines are shared by all instances for a host
+  if host.platform in hostcommands:
+    return hostcommands[host.platform]
+  commands = {}
+  commands['javac'] = toolchain.mkdircmd('$outpath') + ' && $javac -d $outpath -classpath $outpath -sourcepath $sourcepath -target 1.8 -bootclasspath $androidjar -g -source 1.8 -Xlint:-options @$out.rsp'
+  commands['dex'] = 'build/ninja/dexcache.py --dex $dex --output $out $in'
+  commands['aapt'] = toolchain.cdcmd('$apkbuildpath') + ' && $aapt p -f -m -M AndroidManifest.xml -F $apk -I $androidjar -S res --debug-mode --no-crunch -J gen $aaptflags'
+  commands['aaptdeploy'] = toolchain.cdcmd('$apkbuildpath') + ' && $aapt p -f -m -M AndroidManifest.xml -F $apk -I $androidjar -S bin/res -S res -J gen $aaptflags'
+  commands['aaptcrunch'] = '$aapt s -i $in -o $out'
+  commands['aaptadd'] = toolchain.cdcmd('$apkbuildpath') + ' && ' + toolchain.copycmd('$apksource', '$apk' ) + ' && $aapt a $apk $apkaddfiles'
+  commands['zip'] = '$zip -r -9 $out $in $implicitin'
+  commands['codesign'] = 'build/ninja/codesign.py --target $target --prefs codesign.json --zipfile $in --config $config --jarsigner $jarsigner --zipalign $zipalign $out'
+  if host.is_windows():
+    commands['dex'] = 'python ' + commands['dex']
+    commands['codesign'] = 'python ' + commands['codesign']
+  hostcommands[host.platform] = commands
+  return commands
+
+def make_gcc_toolchainnames(version):
+  if version not in gcc_toolchainnames:
+    gcc_toolchainnames[version] = dict((arch, basename + version) for arch, basename in gcc_toolchainbasenames.items())
+  return gcc_toolchainnames[version]
+
+def make_buildtools(sdkpath, host, exe_suffix):
+  #SDK layout does not change during configure, so scan each SDK only once
+  key = (sdkpath, host.platform)
+  if key in buildtools:
+    return buildtools[key]
+
+  buildtools_basepath = os.path.join(sdkpath, 'build-tools')
+  with os.scandir(buildtools_basepath) as entries:
+    buildtools_list = [entry.name for entry in entries if entry.is_dir()]
+  buildtools_list.sort(key = lambda s: tuple(int(x) for x in s.split('-')[0].split('.')))
+
+  buildtools_path = os.path.join(buildtools_basepath, buildtools_list[-1])
+  with os.scandir(buildtools_path) as entries:
+    buildtools_files = set([entry.name for entry in entries if entry.is_file()])
+
+  if host.is_windows():
+    dexname = 'dx.bat'
+  else:
+    dexname = 'dx' + exe_suffix
+  if dexname in buildtools_files:
+    dex = os.path.join(buildtools_path, dexname)
+  else:
+    dex = os.path.join(sdkpath, 'tools', 'dx' + exe_suffix)
+  aapt = os.path.join(buildtools_path, 'aapt' + exe_suffix)
+  if 'zipalign' + exe_suffix in buildtools_files:
+    zipalign = os.path.join(buildtools_path, 'zipalign' + exe_suffix)
+  else:
+    zipalign = os.path.join(sdkpath, 'tools', 'zipalign' + exe_suffix)
+
+  buildtools[key] = (buildtools_path, dex, aapt, zipalign)
+  return buildtools[key]
+
+def make_hostarchname(host):
+  if host.platform in hostarchnames:
+    return hostarchnames[host.platform]
+  hostarchname = None
+  if host.is_windows():
+    if '64' in os.getenv('PROCESSOR_ARCHITECTURE', 'AMD64'):
+      hostarchname = 'windows-x86_64'
+    else:
+      hostarchname = 'windows-x86'
+  elif host.is_linux():
+    if toolchain.get_machine() == 'x86_64':
+      hostarchname = 'linux-x86_64'
+    else:
+      hostarchname = 'linux-x86'
+  elif host.is_macos():
+    hostarchname = 'darwin-x86_64'
+  hostarchnames[host.platform] = hostarchname
+  return hostarchname
+
 class Android(object):
   def __init__(self, toolchain, host, target):
     self.host = host
@@ -19,17 +142,15 @@ class Android(object):
     else:
       self.exe_suffix = ''
 
-    self.javaccmd = toolchain.mkdircmd('$outpath') + ' && $javac -d $outpath -classpath $outpath -sourcepath $sourcepath -target 1.5 -bootclasspath $androidjar -g -source 1.5 -Xlint:-options $in'
-    self.dexcmd = '$dex --dex --output $out $in'
-    self.aaptcmd = toolchain.cdcmd('$apkbuildpath') + ' && $aapt p -f -m -M AndroidManifest.xml -F $apk -I $androidjar -S res --debug-mode --no-crunch -J gen $aaptflags'
-    self.aaptdeploycmd = toolchain.cdcmd('$apkbuildpath') + ' && $aapt c -S res -C bin/res && $aapt p -f -m -M AndroidManifest.xml -F $apk -I $androidjar -S bin/res -S res -J gen $aaptflags'
-    self.aaptaddcmd = toolchain.cdcmd('$apkbuildpath') + ' && ' + toolchain.copycmd('$apksource', '$apk' ) + ' && $aapt a $apk $apkaddfiles'
-    self.zipcmd = '$zip -r -9 $out $in $implicitin'
-    self.zipaligncmd = '$zipalign -f 4 $in $out'
-    self.codesigncmd = 'build/ninja/codesign.py --target $target --prefs codesign.json --zipfile $in --config $config --jarsigner $jarsigner $out'
-
-    if host.is_windows():
-      self.codesigncmd = 'python ' + self.codesigncmd
+    commands = make_commands(toolchain, host)
+    self.javaccmd = commands['javac']
+    self.dexcmd = commands['dex']
+    self.aaptcmd = commands['aapt']
+    self.aaptdeploycmd = commands['aaptdeploy']
+    self.aaptcrunchcmd = commands['aaptcrunch']
+    self.aaptaddcmd = commands['aaptadd']
+    self.zipcmd = commands['zip']
+    self.codesigncmd = commands['codesign']
 
   def initialize_toolchain(self):
     self.ndkpath = os.getenv('NDK_HOME', '')
@@ -39,62 +160,14 @@ class Android(object):
     self.gcc_toolchainversion = '4.9'
     self.javasdk = ''
 
-    self.archname = dict()
-    self.archname['x86'] = 'x86'
-    self.archname['x86-64'] = 'x86_64'
-    self.archname['arm6'] = 'arm'
-    self.archname['arm7'] = 'arm'
-    self.archname['arm64'] = 'arm64'
-    self.archname['mips'] = 'mips'
-    self.archname['mips64'] = 'mips64'
-
-    self.archpath = dict()
-    self.archpath['x86'] = 'x86'
-    self.archpath['x86-64'] = 'x86-64'
-    self.archpath['arm6'] = 'armeabi'
-    self.archpath['arm7'] = 'armeabi-v7a'
-    self.archpath['arm64'] = 'arm64-v8a'
-    self.archpath['mips'] = 'mips'
-    self.archpath['mips64'] = 'mips64'
-
-    self.gcc_toolchainname = dict()
-    self.gcc_toolchainname['x86'] = 'x86-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['x86-64'] = 'x86_64-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['arm6'] = 'arm-linux-androideabi-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['arm7'] = 'arm-linux-androideabi-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['arm64'] = 'aarch64-linux-android-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['mips'] = 'mipsel-linux-android-' + self.gcc_toolchainversion
-    self.gcc_toolchainname['mips64'] = 'mips64el-linux-android-' + self.gcc_toolchainversion
-
-    self.gcc_toolchainprefix = dict()
-    self.gcc_toolchainprefix['x86'] = 'i686-linux-android-'
-    self.gcc_toolchainprefix['x86-64'] = 'x86_64-linux-android-'
-    self.gcc_toolchainprefix['arm6'] = 'arm-linux-androideabi-'
-    self.gcc_toolchainprefix['arm7'] = 'arm-linux-androideabi-'
-    self.gcc_toolchainprefix['arm64'] = 'aarch64-linux-android-'
-    self.gcc_toolchainprefix['mips'] = 'mipsel-linux-android-'
-    self.gcc_toolchainprefix['mips64'] = 'mips64el-linux-android-'
-
-    if self.host.is_windows():
-      if os.getenv('PROCESSOR_ARCHITECTURE', 'AMD64').find('64') != -1:
-        self.hostarchname = 'windows-x86_64'
-      else:
-        self.hostarchname = 'windows-x86'
-    elif self.host.is_linux():
-        localarch = toolchain.check_output(['uname', '-m'])
-        if localarch == 'x86_64':
-          self.hostarchname = 'linux-x86_64'
-        else:
-          self.hostarchname = 'linux-x86'
-    elif self.host.is_macos():
-      self.hostarchname = 'darwin-x86_64'
+    self.archname = archnames
+    self.archpath = archpaths
+    self.gcc_toolchainprefix = gcc_toolchainprefixes
 
-  def build_toolchain(self):
-    buildtools_path = os.path.join(self.sdkpath, 'build-tools')
-    buildtools_list = [item for item in os.listdir(buildtools_path) if os.path.isdir(os.path.join(buildtools_path, item))]
-    buildtools_list.sort(key = lambda s: map(int, s.split('-')[0].split('.')))
+    self.hostarchname = make_hostarchname(self.host)
 
-    self.buildtools_path = os.path.join(self.sdkpath, 'build-tools', buildtools_list[-1])
+  def build_toolchain(self):
+    self.buildtools_path, self.dex, self.aapt, self.zipalign = make_buildtools(self.sdkpath, self.host, self.exe_suffix)
     self.android_jar = os.path.join(self.sdkpath, 'platforms', 'android-' + self.platformversion, 'android.jar')
 
     self.javac = 'javac'
@@ -102,16 +175,15 @@ class Android(object):
     if self.javasdk != '':
       self.javac = os.path.join(self.javasdk, 'bin', self.javac)
       self.jarsigner = os.path.join(self.javasdk, 'bin', self.jarsigner)
-    if self.host.is_windows():
-      self.dex = os.path.join(self.buildtools_path, 'dx.bat')
-    else:
-      self.dex = os.path.join(self.buildtools_path, 'dx' + self.exe_suffix)
-    if not os.path.isfile(self.dex):
-      self.dex = os.path.join(self.sdkpath, 'tools', 'dx' + self.exe_suffix)
-    self.aapt = os.path.join(self.buildtools_path, 'aapt' + self.exe_suffix)
-    self.zipalign = os.path.join(self.buildtools_path, 'zipalign' + self.exe_suffix)
-    if not os.path.isfile( self.zipalign ):
-      self.zipalign = os.path.join(self.sdkpath, 'tools', 'zipalign' + self.exe_suffix)
+
+    gcc_toolchainname = make_gcc_toolchainnames(self.gcc_toolchainversion)
+    self.sysroot_paths = {}
+    self.gcc_toolchain_paths = {}
+    self.gcc_bin_paths = {}
+    for arch in self.archname:
+      self.sysroot_paths[arch] = os.path.join(self.ndkpath, 'platforms', 'android-' + self.platformversion, 'arch-' + self.archname[arch])
+      self.gcc_toolchain_paths[arch] = os.path.join(self.ndkpath, 'toolchains', gcc_toolchainname[arch], 'prebuilt', self.hostarchname)
+      self.gcc_bin_paths[arch] = os.path.join(self.gcc_toolchain_paths[arch], 'bin', self.gcc_toolchainprefix[arch])
 
   def parse_prefs(self, prefs):
     if 'android' in prefs:
@@ -146,36 +218,26 @@ class Android(object):
   def write_rules(self, writer):
     writer.rule('aapt', command = self.aaptcmd, description = 'AAPT $out')
     writer.rule('aaptdeploy', command = self.aaptdeploycmd, description = 'AAPT $out')
+    writer.rule('aaptcrunch', command = self.aaptcrunchcmd, description = 'CRUNCH $out')
     writer.rule('aaptadd', command = self.aaptaddcmd, description = 'AAPT $out')
-    writer.rule('javac', command = self.javaccmd, description = 'JAVAC $in')
+    writer.rule('javac', command = self.javaccmd, rspfile = '$out.rsp', rspfile_content = '$in', description = 'JAVAC $in')
     writer.rule('dex', command = self.dexcmd, description = 'DEX $out')
     writer.rule('zip', command = self.zipcmd, description = 'ZIP $out')
-    writer.rule('zipalign', command = self.zipaligncmd, description = 'ZIPALIGN $out')
     writer.rule('codesign', command = self.codesigncmd, description = 'CODESIGN $out')
 
   def make_sysroot_path(self, arch):
-    return os.path.join(self.ndkpath, 'platforms', 'android-' + self.platformversion, 'arch-' + self.archname[arch])
+    return self.sysroot_paths[arch]
 
   def make_gcc_toolchain_path(self, arch):
-    return os.path.join(self.ndkpath, 'toolchains', self.gcc_toolchainname[arch], 'prebuilt', self.hostarchname)
+    return self.gcc_toolchain_paths[arch]
 
   def make_gcc_bin_path(self, arch):
-    return os.path.join(self.make_gcc_toolchain_path(arch), 'bin', self.gcc_toolchainprefix[arch])
-
-  def archname(self):
-    return self.archname
-
-  def archpath(self):
-    return self.archpath
-
-  def hostarchname(self):
-    return self.hostarchname
+    return self.gcc_bin_paths[arch]
 
   def apk(self, toolchain, writer, module, archbins, javasources, outpath, binname, basepath, config, implicit_deps, resources):
     buildpath = os.path.join('$buildpath', config, 'apk', binname)
     baseapkname = binname + ".base.apk"
     unsignedapkname = binname + ".unsigned.apk"
-    unalignedapkname = binname + ".unaligned.apk"
     apkname = binname + ".apk"
     apkfiles = []
     libfiles = []
@@ -183,26 +245,42 @@ class Android(object):
     resfiles = []
     manifestfile = []
 
+    #Path prefixes for the loops below, all components are plain relative names
+    buildprefix = buildpath + os.sep
+    sourceprefix = os.path.join(basepath, module, '')
+    resprefix = os.path.join(buildpath, 'res', '')
+    binresprefix = os.path.join(buildpath, 'bin', 'res', '')
+
     writer.comment('Make APK')
-    for _, value in archbins.iteritems():
+    archlibpaths = self.archpath
+    for value in archbins.values():
       for archbin in value:
-        archpair = os.path.split(archbin)
-        libname = archpair[1]
-        arch = os.path.split(archpair[0])[1]
-        locallibpath = os.path.join('lib', self.archpath[arch], libname)
-        archpath = os.path.join(buildpath, locallibpath)
+        arch, libname = archbin.replace('/', os.sep).rsplit(os.sep, 2)[-2:]
+        locallibpath = 'lib' + os.sep + archlibpaths[arch] + os.sep + libname
         locallibs += [locallibpath + ' ']
-        libfiles += toolchain.copy(writer, archbin, archpath)
+        libfiles += toolchain.copy(writer, archbin, buildprefix + locallibpath)
+    restypes = []
+    ressources = {}
+    pngresources = []
     for resource in resources:
-      filename = os.path.split(resource)[1]
+      respath = resource.replace('\\', '/').rsplit('/', 2)
+      filename = respath[-1]
       if filename == 'AndroidManifest.xml':
-        manifestfile = toolchain.copy(writer, os.path.join(basepath, module, resource), os.path.join(buildpath, 'AndroidManifest.xml'))
+        manifestfile = toolchain.copy(writer, sourceprefix + resource, buildprefix + 'AndroidManifest.xml')
       else:
-        restype = os.path.split(os.path.split(resource)[0])[1]
+        restype = respath[-2] if len(respath) > 1 else ''
         if restype == 'asset':
           pass #todo: implement
         else:
-          resfiles += toolchain.copy(writer, os.path.join(basepath, module, resource), os.path.join(buildpath, 'res', restype, filename))
+          if not restype in ressources:
+            restypes += [restype]
+            ressources[restype] = []
+          ressources[restype] += [sourceprefix + resource]
+          if filename.endswith('.png'):
+            pngresources += [os.path.join(restype, filename)]
+    #Copy resources with one edge per resource type directory
+    for restype in restypes:
+      resfiles += toolchain.copy_files(writer, ressources[restype], resprefix + restype)
 
     #Make directories
     gendir = toolchain.mkdir(writer, os.path.join(buildpath, 'gen'))
@@ -213,7 +291,11 @@ class Android(object):
     aaptvars = [('apkbuildpath', buildpath), ('apk', baseapkname)]
     aaptout = os.path.join(buildpath, baseapkname)
     if config == 'deploy':
-      baseapkfile = writer.build(aaptout, 'aaptdeploy', manifestfile, variables = aaptvars, implicit = manifestfile + resfiles, order_only = alldirs)
+      #Crunch each PNG in a separate edge so only modified images are crunched again
+      crunchfiles = []
+      for pngresource in pngresources:
+        crunchfiles += writer.build(binresprefix + pngresource, 'aaptcrunch', resprefix + pngresource, order_only = binresdir)
+      baseapkfile = writer.build(aaptout, 'aaptdeploy', manifestfile, variables = aaptvars, implicit = manifestfile + resfiles + crunchfiles, order_only = alldirs)
     else:
       baseapkfile = writer.build(aaptout, 'aapt', manifestfile, variables = aaptvars, implicit = manifestfile + resfiles, order_only = alldirs)
 
@@ -221,28 +303,20 @@ class Android(object):
     javafiles = []
     localjava = []
     if javasources != []:
-      #self.javaccmd = '$javac -d $outpath -classpath $outpath -sourcepath $sourcepath -target 1.5 -bootclasspath $androidjar -g -source 1.5 -Xlint:-options $in'
+      #self.javaccmd = '$javac -d $outpath -classpath $outpath -sourcepath $sourcepath -target 1.8 -bootclasspath $androidjar -g -source 1.8 -Xlint:-options @$out.rsp'
       #self.dexcmd = '$dex --dex --output $out $in'
-      javasourcepath = '.'
-      if self.host.is_windows():
-        javasourcepath += ';'
-      else:
-        javasourcepath += ':'
-      javasourcepath += os.path.join(buildpath, 'gen')
+      javasourcepath = os.pathsep.join(['.', os.path.join(buildpath, 'gen')])
       classpath = os.path.join(buildpath, 'classes')
       javavars = [('outpath', classpath), ('sourcepath', javasourcepath)]
       javaclasses = writer.build(classpath, 'javac', javasources, variables = javavars, implicit = baseapkfile)
       localjava += ['classes.dex']
-      javafiles += writer.build(os.path.join(buildpath, 'classes.dex'), 'dex', classpath)
+      javafiles += writer.build(os.path.join(buildpath, 'classes.dex'), 'dex', classpath, implicit = [os.path.join('build', 'ninja', 'dexcache.py')])
 
     #Add native libraries and java classes to apk
     aaptvars = [('apkbuildpath', buildpath), ('apk', unsignedapkname), ('apksource', baseapkname), ('apkaddfiles', toolchain.paths_forward_slash(locallibs + localjava))]
     unsignedapkfile = writer.build(os.path.join(buildpath, unsignedapkname), 'aaptadd', baseapkfile, variables = aaptvars, implicit = libfiles + javafiles, order_only = alldirs)
 
-    #Sign the APK
+    #Sign and zipalign the APK
     codesignvars = [('config', config)]
-    unalignedapkfile = writer.build(os.path.join(buildpath, unalignedapkname), 'codesign', unsignedapkfile, variables = codesignvars)
-
-    #Run zipalign
-    outfile = writer.build(os.path.join(outpath, config, apkname), 'zipalign', unalignedapkfile)
+    outfile = writer.build(os.path.join(outpath, config, apkname), 'codesign', unsignedapkfile, variables = codesignvars)
     return outfile
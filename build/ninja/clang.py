@@ -3,43 +3,80 @@
 """Ninja toolchain abstraction for Clang compiler suite"""
 
 import os
+import shlex
+import shutil
 import subprocess
+import sys
 
 import toolchain
+import xcode
+
+def freeze_flags(flags):
+  return tuple(sys.intern(flag) for flag in flags)
+
+def make_envflags(host, name):
+  value = os.environ.get(name) or ''
+  if host.is_windows():
+    return value.split()
+  return [shlex.quote(flag) for flag in shlex.split(value)]
 
 class ClangToolchain(toolchain.Toolchain):
 
   def initialize(self, project, archs, configs, includepaths, dependlibs, libpaths, variables, subninja):
+    #Cached target checks
+    self.iswindows = self.target.is_windows()
+    self.ismacos = self.target.is_macos()
+    self.isios = self.target.is_ios()
+    self.isapple = self.ismacos or self.isios
+    self.isandroid = self.target.is_android()
+    self.islinux = self.target.is_linux()
+    self.isbsd = self.target.is_bsd()
+    self.israspberrypi = self.target.is_raspberrypi()
+    self.issunos = self.target.is_sunos()
+    self.ishaiku = self.target.is_haiku()
+
     #Local variable defaults
     self.toolchain = ''
     self.sdkpath = ''
     self.includepaths = []
     self.libpaths = libpaths
+    self.ltomode = 'thin'
+    self.modules = False
+    self.ccache = os.environ.get('CCACHE') or None
+    self.cenvflags = make_envflags(self.host, 'CFLAGS')
+    self.cxxenvflags = make_envflags(self.host, 'CXXFLAGS')
+    self.arenvflags = make_envflags(self.host, 'ARFLAGS')
+    self.linkenvflags = make_envflags(self.host, 'LDFLAGS')
     self.ccompiler = os.environ.get('CC') or 'clang'
     self.cxxcompiler = os.environ.get('CXX') or 'clang++'
-    if self.target.is_windows():
+    if self.iswindows:
       self.archiver = os.environ.get('AR') or 'llvm-ar'
       self.linker = os.environ.get('CC') or 'lld-link'
       self.cxxlinker = os.environ.get('CXX') or 'lld-link'
     else:
-      self.archiver = os.environ.get('AR') or 'ar'
+      self.archiver = os.environ.get('AR') or None
       self.linker = os.environ.get('CC') or 'clang'
       self.cxxlinker = os.environ.get('CXX') or 'clang++'
+    self.fuseld = None
 
     #Default variables
     self.sysroot = ''
-    if self.target.is_ios():
+    if self.isios:
       self.deploymenttarget = '9.0'
-    if self.target.is_macos():
+    if self.ismacos:
       self.deploymenttarget = '10.7'
 
-    #Command definitions
-    self.cccmd = '$toolchain$cc -MMD -MT $out -MF $out.d $includepaths $moreincludepaths $cflags $carchflags $cconfigflags $cmoreflags $cenvflags -c $in -o $out'
-    self.cxxcmd = '$toolchain$cxx -MMD -MT $out -MF $out.d $includepaths $moreincludepaths $cxxflags $carchflags $cconfigflags $cmoreflags $cxxenvflags -c $in -o $out'
+    #Command definitions (compiles go through $ccache when available, set CCACHE_SLOPPINESS=random_seed,time_macros for best hit rate)
+    self.cccmd = '$ccache $toolchain$cc -MMD -MP -MF $out.d $includepaths $moreincludepaths $cflags $cwarnflags $carchflags $cconfigflags $cmoreflags $cenvflags -c $in -o $out'
+    self.cxxcmd = '$ccache $toolchain$cxx -MMD -MP -MF $out.d $includepaths $moreincludepaths $cxxflags $cwarnflags $carchflags $cconfigflags $cmoreflags $cxxenvflags -c $in -o $out'
     self.ccdeps = 'gcc'
     self.ccdepfile = '$out.d'
-    self.arcmd = self.rmcmd('$out') + ' && $toolchain$ar crs $ararchflags $arflags $arenvflags $out $in'
-    if self.target.is_windows():
+    if self.host.is_windows():
+      self.arcmd = self.rmcmd('$out') + ' && $toolchain$ar crs $ararchflags $arflags $arenvflags $out $in'
+    else:
+      #Reset to an empty archive with a shell builtin instead of spawning rm, ar would otherwise keep stale members
+      self.arcmd = 'printf \'!<arch>\\n\' > $out && $toolchain$ar crs $ararchflags $arflags $arenvflags $out $in'
+    if self.iswindows:
       self.linkcmd = '$toolchain$link $libpaths $configlibpaths $linkflags $linkarchflags $linkconfigflags $linkenvflags /debug /nologo /subsystem:console /dynamicbase /nxcompat /manifest /manifestuac:\"level=\'asInvoker\' uiAccess=\'false\'\" /tlbid:1 /pdb:$pdbpath /out:$out $in $libs $archlibs $oslibs $frameworks'
       self.dllcmd = self.linkcmd + ' /dll'
     else:
@@ -47,9 +84,10 @@ class ClangToolchain(toolchain.Toolchain):
 
     #Base flags
     self.cflags = ['-D' + project.upper() + '_COMPILE=1',
-                   '-funit-at-a-time', '-fstrict-aliasing', '-fvisibility=hidden', '-fno-stack-protector',
-                   '-fomit-frame-pointer', '-fno-math-errno','-ffinite-math-only', '-funsafe-math-optimizations',
-                   '-fno-trapping-math', '-ffast-math']
+                   '-fstrict-aliasing', '-fvisibility=hidden', '-fno-stack-protector',
+                   '-fomit-frame-pointer', '-ffast-math', '-fno-math-errno', '-pipe']
+    if not self.iswindows and not self.isapple:
+      self.cflags += ['-fno-plt']
     self.cwarnflags = ['-W', '-Werror', '-pedantic', '-Wall', '-Weverything',
                        '-Wno-c++98-compat', '-Wno-padded', '-Wno-documentation-unknown-command',
                        '-Wno-implicit-fallthrough', '-Wno-static-in-inline', '-Wno-reserved-id-macro', '-Wno-disabled-macro-expansion']
@@ -70,22 +108,43 @@ class ClangToolchain(toolchain.Toolchain):
     self.parse_default_variables(variables)
     self.read_build_prefs()
 
-    if self.target.is_linux() or self.target.is_bsd() or self.target.is_raspberrypi() or self.target.is_sunos():
+    #Only probe PATH for tools not already given by environment or prefs
+    if self.ccache is None:
+      self.ccache = shutil.which('ccache') or ''
+    if self.archiver is None:
+      #GNU ar writes no symbol index for bitcode members unless the LLVMgold plugin is installed
+      self.archiver = 'ar'
+      if self.use_lto():
+        self.archiver = 'llvm-ar'
+    if self.fuseld is None:
+      self.fuseld = ''
+      if not self.iswindows and not self.isandroid and not self.isapple:
+        #BFD ld cannot read clang bitcode and mold needs the LLVMgold plugin for it, lld reads it natively
+        if self.use_lto():
+          self.fuseld = 'lld'
+        elif shutil.which('ld.mold'):
+          self.fuseld = 'mold'
+        elif shutil.which('ld.lld'):
+          self.fuseld = 'lld'
+
+    if self.islinux or self.isbsd or self.israspberrypi or self.issunos:
       self.cflags += ['-D_GNU_SOURCE=1']
       self.linkflags += ['-pthread']
       self.oslibs += ['m']
-    if self.target.is_linux() or self.target.is_raspberrypi():
+    if self.islinux or self.israspberrypi:
       self.oslibs += ['dl']
-    if self.target.is_raspberrypi():
+    if self.israspberrypi:
       self.linkflags += ['-latomic']
-    if self.target.is_bsd():
+    if self.isbsd:
       self.oslibs += ['execinfo']
-    if self.target.is_haiku():
+    if self.ishaiku:
       self.cflags += ['-D_GNU_SOURCE=1']
       self.linkflags += ['-lpthread']
       self.oslibs += ['m']
-    if not self.target.is_windows():
+    if not self.iswindows:
       self.linkflags += ['-fomit-frame-pointer']
+    if self.fuseld != '':
+      self.linkflags += ['-fuse-ld=' + self.fuseld]
 
     self.includepaths = self.prefix_includepaths((includepaths or []) + ['.'])
 
@@ -94,15 +153,17 @@ class ClangToolchain(toolchain.Toolchain):
     if self.use_coverage():
       self.cflags += ['--coverage']
       self.linkflags += ['--coverage']
+    if self.modules:
+      #Implicit modules parse system headers once and share them across all compiles
+      self.cflags += ['-fmodules', '-fmodules-cache-path=' + os.path.join('$buildpath', 'modules')]
 
-    if not 'nowarning' in variables or not variables['nowarning']:
-      self.cflags += self.cwarnflags
-    else:
+    if 'nowarning' in variables and variables['nowarning']:
+      self.cwarnflags = []
       self.cflags += ['-w']
     self.cxxflags = list(self.cflags)
 
     self.cflags += ['-std=c11']
-    if self.target.is_macos() or self.target.is_ios():
+    if self.isapple:
       self.cxxflags += ['-std=c++14', '-stdlib=libc++']
     else:
       self.cxxflags += ['-std=c++14']
@@ -117,7 +178,7 @@ class ClangToolchain(toolchain.Toolchain):
     self.builders['lib'] = self.builder_lib
     self.builders['sharedlib'] = self.builder_sharedlib
     self.builders['bin'] = self.builder_bin
-    if self.target.is_macos() or self.target.is_ios():
+    if self.isapple:
       self.builders['m'] = self.builder_cm
       self.builders['multilib'] = self.builder_apple_multilib
       self.builders['multisharedlib'] = self.builder_apple_multisharedlib
@@ -130,6 +191,14 @@ class ClangToolchain(toolchain.Toolchain):
     #Setup target platform
     self.build_toolchain()
 
+    #Flags are final once the target platform is set up
+    self.cflags = freeze_flags(self.cflags)
+    self.cwarnflags = freeze_flags(self.cwarnflags)
+    self.cxxflags = freeze_flags(self.cxxflags)
+    self.mflags = freeze_flags(self.mflags)
+    self.arflags = freeze_flags(self.arflags)
+    self.linkflags = freeze_flags(self.linkflags)
+
   def name(self):
     return 'clang'
 
@@ -143,77 +212,104 @@ class ClangToolchain(toolchain.Toolchain):
           self.toolchain = os.path.join(self.toolchain, 'bin')
       if 'archiver' in clangprefs:
         self.archiver = clangprefs['archiver']
-    if self.target.is_ios() and 'ios' in prefs:
+      if 'modules' in clangprefs:
+        self.modules = toolchain.get_boolean_flag(clangprefs['modules'])
+      if 'linker' in clangprefs:
+        self.fuseld = clangprefs['linker']
+      if 'lto' in clangprefs:
+        if clangprefs['lto'] == 'off':
+          self.build_lto = False
+        else:
+          self.ltomode = clangprefs['lto']
+      if 'ccache' in clangprefs:
+        if isinstance(clangprefs['ccache'], bool):
+          if not clangprefs['ccache']:
+            self.ccache = ''
+          elif not self.ccache:
+            self.ccache = 'ccache'
+        else:
+          self.ccache = clangprefs['ccache']
+    if self.isios and 'ios' in prefs:
       iosprefs = prefs['ios']
       if 'deploymenttarget' in iosprefs:
         self.deploymenttarget = iosprefs['deploymenttarget']
-    if self.target.is_macos() and 'macos' in prefs:
+    if self.ismacos and 'macos' in prefs:
       macosprefs = prefs['macos']
       if 'deploymenttarget' in macosprefs:
         self.deploymenttarget = macosprefs['deploymenttarget']
 
   def write_variables(self, writer):
     super(ClangToolchain, self).write_variables(writer)
-    writer.variable('toolchain', self.toolchain)
-    writer.variable('sdkpath', self.sdkpath)
-    writer.variable('sysroot', self.sysroot)
-    writer.variable('cc', self.ccompiler)
-    writer.variable('cxx', self.cxxcompiler)
-    writer.variable('ar', self.archiver)
-    writer.variable('link', self.linker)
-    if self.target.is_macos() or self.target.is_ios():
-      writer.variable('lipo', self.lipo)
-    writer.variable('includepaths', self.make_includepaths(self.includepaths))
-    writer.variable('moreincludepaths', '')
-    writer.variable('cflags', self.cflags)
-    writer.variable('cxxflags', self.cxxflags)
-    if self.target.is_macos() or self.target.is_ios():
-      writer.variable('mflags', self.mflags)
-    writer.variable('carchflags', '')
-    writer.variable('cconfigflags', '')
-    writer.variable('cmoreflags', self.cmoreflags)
-    writer.variable('cenvflags', (os.environ.get('CFLAGS') or '').split())
-    writer.variable('cxxenvflags', (os.environ.get('CXXFLAGS') or '').split())
-    writer.variable('arflags', self.arflags)
-    writer.variable('ararchflags', '')
-    writer.variable('arconfigflags', '')
-    writer.variable('arenvflags', (os.environ.get('ARFLAGS') or '').split())
-    writer.variable('linkflags', self.linkflags)
-    writer.variable('linkarchflags', '')
-    writer.variable('linkconfigflags', '')
-    writer.variable('linkenvflags', (os.environ.get('LDFLAGS') or '').split())
-    writer.variable('libs', '')
-    writer.variable('libpaths', self.make_libpaths(self.libpaths))
-    writer.variable('configlibpaths', '')
-    writer.variable('archlibs', '')
-    writer.variable('oslibs', self.make_libs(self.oslibs))
-    writer.variable('frameworks', '')
-    if self.target.is_windows():
-      writer.variable('pdbpath', 'ninja.pdb')
+    variables = []
+    variables += [('toolchain', self.toolchain)]
+    variables += [('sdkpath', self.sdkpath)]
+    variables += [('sysroot', self.sysroot)]
+    variables += [('ccache', self.ccache)]
+    variables += [('cc', self.ccompiler)]
+    variables += [('cxx', self.cxxcompiler)]
+    variables += [('ar', self.archiver)]
+    variables += [('link', self.linker)]
+    if self.isapple:
+      variables += [('lipo', self.lipo)]
+    variables += [('includepaths', self.make_includepaths(self.includepaths))]
+    variables += [('moreincludepaths', '')]
+    variables += [('cflags', self.cflags)]
+    variables += [('cxxflags', self.cxxflags)]
+    if self.isapple:
+      variables += [('mflags', self.mflags)]
+    variables += [('carchflags', '')]
+    variables += [('cconfigflags', '')]
+    variables += [('cwarnflags', self.cwarnflags)]
+    variables += [('cmoreflags', self.cmoreflags)]
+    variables += [('cenvflags', self.cenvflags)]
+    variables += [('cxxenvflags', self.cxxenvflags)]
+    variables += [('arflags', self.arflags)]
+    variables += [('ararchflags', '')]
+    variables += [('arconfigflags', '')]
+    variables += [('arenvflags', self.arenvflags)]
+    variables += [('linkflags', self.linkflags)]
+    variables += [('linkarchflags', '')]
+    variables += [('linkconfigflags', '')]
+    variables += [('linkenvflags', self.linkenvflags)]
+    variables += [('libs', '')]
+    variables += [('libpaths', self.make_libpaths(self.libpaths))]
+    variables += [('configlibpaths', '')]
+    variables += [('archlibs', '')]
+    variables += [('oslibs', self.make_libs(self.oslibs))]
+    variables += [('frameworks', '')]
+    if self.iswindows:
+      variables += [('pdbpath', 'ninja.pdb')]
+    writer.variables(variables)
     writer.newline()
 
   def write_rules(self, writer):
     super(ClangToolchain, self).write_rules(writer)
+    #Linkers and ThinLTO backends are multithreaded, limit concurrent link jobs
+    linkpooldepth = 1
+    if not self.use_lto():
+      linkpooldepth = max(1, (os.cpu_count() or 1) // 4)
+    writer.pool('link_pool', linkpooldepth)
+    writer.newline()
     writer.rule('cc', command = self.cccmd, depfile = self.ccdepfile, deps = self.ccdeps, description = 'CC $in')
     writer.rule('cxx', command = self.cxxcmd, depfile = self.ccdepfile, deps = self.ccdeps, description = 'CXX $in')
-    if self.target.is_macos() or self.target.is_ios():
+    if self.isapple:
       writer.rule('cm', command = self.cmcmd, depfile = self.ccdepfile, deps = self.ccdeps, description = 'CM $in')
       writer.rule( 'lipo', command = self.lipocmd, description = 'LIPO $out' )
     writer.rule('ar', command = self.arcmd, description = 'LIB $out')
-    writer.rule('link', command = self.linkcmd, description = 'LINK $out')
-    if self.target.is_windows():
-      writer.rule('dll', command = self.dllcmd, description = 'DLL $out')
+    writer.rule('link', command = self.linkcmd, pool = 'link_pool', description = 'LINK $out')
+    if self.iswindows:
+      writer.rule('dll', command = self.dllcmd, pool = 'link_pool', description = 'DLL $out')
     else:
-      writer.rule('so', command = self.linkcmd, description = 'SO $out')
+      writer.rule('so', command = self.linkcmd, pool = 'link_pool', description = 'SO $out')
     writer.newline()
 
   def build_toolchain(self):
     super(ClangToolchain, self).build_toolchain()
-    if self.target.is_windows():
+    if self.iswindows:
       self.build_windows_toolchain()
-    elif self.target.is_android():
+    elif self.isandroid:
       self.build_android_toolchain()
-    elif self.target.is_macos() or self.target.is_ios():
+    elif self.isapple:
       self.build_xcode_toolchain()
     if self.toolchain != '' and not self.toolchain.endswith('/') and not self.toolchain.endswith('\\'):
       self.toolchain += os.sep
@@ -240,14 +336,14 @@ class ClangToolchain(toolchain.Toolchain):
     self.toolchain = os.path.join('$ndk', 'toolchains', 'llvm', 'prebuilt', self.android.hostarchname, 'bin', '')
 
   def build_xcode_toolchain(self):
-    if self.target.is_macos():
+    if self.ismacos:
       sdk = 'macosx'
       deploytarget = 'MACOSX_DEPLOYMENT_TARGET=' + self.deploymenttarget
       self.cflags += ['-fasm-blocks', '-mmacosx-version-min=' + self.deploymenttarget, '-isysroot', '$sysroot']
       self.cxxflags += ['-fasm-blocks', '-mmacosx-version-min=' + self.deploymenttarget, '-isysroot', '$sysroot']
       self.arflags += ['-static', '-no_warning_for_no_symbols']
       self.linkflags += ['-isysroot', '$sysroot']
-    elif self.target.is_ios():
+    elif self.isios:
       sdk = 'iphoneos'
       deploytarget = 'IPHONEOS_DEPLOYMENT_TARGET=' + self.deploymenttarget
       self.cflags += ['-fasm-blocks', '-miphoneos-version-min=' + self.deploymenttarget, '-isysroot', '$sysroot']
@@ -256,32 +352,39 @@ class ClangToolchain(toolchain.Toolchain):
       self.linkflags += ['-isysroot', '$sysroot']
     self.cflags += ['-fembed-bitcode-marker']
 
-    platformpath = toolchain.check_output(['xcrun', '--sdk', sdk, '--show-sdk-platform-path'])
+    xcode.xcrun_prefetch(sdk, [('--show-sdk-path',), ('-f', 'clang'), ('-f', 'libtool'), ('-f', 'lipo')])
+    platformpath = xcode.platform_path(sdk)
     localpath = platformpath + "/Developer/usr/bin:/Applications/Xcode.app/Contents/Developer/usr/bin:/usr/bin:/bin:/usr/sbin:/sbin"
 
-    self.sysroot = toolchain.check_output(['xcrun', '--sdk', sdk, '--show-sdk-path'])
+    self.sysroot = xcode.xcrun(sdk, '--show-sdk-path')
 
-    self.ccompiler = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'clang'])
-    self.archiver = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'libtool'])
+    clang = xcode.xcrun(sdk, '-f', 'clang')
+    self.ccompiler = "PATH=" + localpath + " " + clang
+    self.archiver = "PATH=" + localpath + " " + xcode.xcrun(sdk, '-f', 'libtool')
     self.linker = deploytarget + " " + self.ccompiler
-    self.lipo = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'lipo'])
+    if self.ccache != '':
+      #Environment assignment must come first in the command, so wrap the compiler itself
+      self.ccompiler = "PATH=" + localpath + " " + self.ccache + " " + clang
+      self.ccache = ''
+    self.lipo = "PATH=" + localpath + " " + xcode.xcrun(sdk, '-f', 'lipo')
 
     self.mflags += list(self.cflags) + ['-fobjc-arc', '-fno-objc-exceptions', '-x', 'objective-c']
     self.cflags += ['-x', 'c']
     self.cxxflags += ['-x', 'c++']
 
     self.cmcmd = self.cccmd.replace('$cflags', '$mflags')
-    self.arcmd = self.rmcmd('$out') + ' && $ar $ararchflags $arflags $in -o $out'
+    #libtool always writes a fresh archive
+    self.arcmd = '$ar $ararchflags $arflags $in -o $out'
     self.lipocmd = '$lipo $in -create -output $out'
 
-    if self.target.is_macos():
+    if self.ismacos:
       self.frameworks = ['Cocoa', 'CoreFoundation']
-    if self.target.is_ios():
+    if self.isios:
       self.frameworks = ['CoreGraphics', 'UIKit', 'Foundation']
 
   def make_includepaths(self, includepaths):
     if not includepaths is None:
-      return ['-I' + path for path in list(includepaths)]
+      return self.memoize_flags('includepaths', includepaths, lambda paths: ['-I' + path for path in paths])
     return []
 
   def make_libpath(self, path):
@@ -289,14 +392,14 @@ class ClangToolchain(toolchain.Toolchain):
 
   def make_libpaths(self, libpaths):
     if not libpaths is None:
-      if self.target.is_windows():
-        return ['/libpath:' + self.path_escape(path) for path in libpaths]
-      return ['-L' + self.make_libpath(path) for path in libpaths]
+      if self.iswindows:
+        return self.memoize_flags('libpaths', libpaths, lambda paths: ['/libpath:' + self.path_escape(path) for path in paths])
+      return self.memoize_flags('libpaths', libpaths, lambda paths: ['-L' + self.make_libpath(path) for path in paths])
     return []
 
   def make_targetarchflags(self, arch, targettype):
     flags = []
-    if self.target.is_android():
+    if self.isandroid:
       if arch == 'x86':
         flags += ['-target', 'i686-none-linux-android']
         flags += ['-march=i686', '-mtune=intel', '-mssse3', '-mfpmath=sse', '-m32']
@@ -316,7 +419,7 @@ class ClangToolchain(toolchain.Toolchain):
       elif arch == 'mips64':
         flags += ['-target', 'mips64el-none-linux-android']
       flags += ['-gcc-toolchain', self.android.make_gcc_toolchain_path(arch)]
-    elif self.target.is_macos() or self.target.is_ios():
+    elif self.isapple:
       if arch == 'x86':
         flags += ['-arch', 'x86']
       elif arch == 'x86-64':
@@ -325,7 +428,7 @@ class ClangToolchain(toolchain.Toolchain):
         flags += ['-arch', 'armv7']
       elif arch == 'arm64':
         flags += ['-arch', 'arm64']
-    elif self.target.is_windows():
+    elif self.iswindows:
       if arch == 'x86':
         flags += ['-target', 'x86-pc-windows-msvc']
       elif arch == 'x64':
@@ -341,7 +444,7 @@ class ClangToolchain(toolchain.Toolchain):
     flags = []
     if targettype == 'sharedlib':
       flags += ['-DBUILD_DYNAMIC_LINK=1']
-      if self.target.is_linux() or self.target.is_bsd() or self.target.is_sunos():
+      if self.islinux or self.isbsd or self.issunos:
        flags += ['-fPIC']
     flags += self.make_targetarchflags(arch, targettype)
     return flags
@@ -356,6 +459,8 @@ class ClangToolchain(toolchain.Toolchain):
       flags += ['-DBUILD_PROFILE=1', '-O3', '-funroll-loops']
     elif config == 'deploy':
       flags += ['-DBUILD_DEPLOY=1', '-O3', '-funroll-loops']
+    if config != 'debug' and self.use_lto():
+      flags += ['-flto=' + self.ltomode]
     return flags
 
   def make_ararchflags(self, arch, targettype):
@@ -369,41 +474,47 @@ class ClangToolchain(toolchain.Toolchain):
   def make_linkarchflags(self, arch, targettype, variables):
     flags = []
     flags += self.make_targetarchflags(arch, targettype)
-    if self.target.is_android():
+    if self.isandroid:
       if arch == 'arm7':
         flags += ['-Wl,--no-warn-mismatch', '-Wl,--fix-cortex-a8']
-    if self.target.is_windows():
+    if self.iswindows:
       # Ignore target arch flags from above, add link style arch instead
       flags = []
       if arch == 'x86':
         flags += ['/machine:x86']
       elif arch == 'x86-64':
         flags += ['/machine:x64']
-    if self.target.is_macos() and variables != None and 'support_lua' in variables and variables['support_lua']:
+    if self.ismacos and variables != None and 'support_lua' in variables and variables['support_lua']:
       flags += ['-pagezero_size', '10000', '-image_base', '100000000']
     return flags
 
   def make_linkconfigflags(self, config, targettype, variables):
     flags = []
-    if self.target.is_windows():
+    if self.iswindows:
       if config == 'debug':
         flags += ['/incremental', '/defaultlib:libcmtd']
       else:
         flags += ['/incremental:no', '/opt:ref', '/opt:icf', '/defaultlib:libcmt']
-    elif self.target.is_macos() or self.target.is_ios():
+        if self.use_lto() and self.ltomode == 'thin':
+          flags += ['/opt:lldltojobs=all']
+    elif self.isapple:
       if targettype == 'sharedlib' or targettype == 'multisharedlib':
         flags += ['-dynamiclib']
     else:
       if targettype == 'sharedlib':
         flags += ['-shared', '-fPIC']
-    if config != 'debug':
+    if config != 'debug' and not self.iswindows:
+      #lld-link picks up LTO from the bitcode objects on its own
       if (targettype == 'bin' or targettype == 'sharedlib') and self.use_lto():
-        flags += ['-flto']
+        flags += ['-flto=' + self.ltomode]
+        #ThinLTO backends otherwise use one thread per physical core, the link pool already serializes links
+        if self.ltomode == 'thin' and self.fuseld == 'lld':
+          flags += ['-Wl,--thinlto-jobs=all']
     return flags
 
   def make_linkarchlibs(self, arch, targettype):
     archlibs = []
-    if self.target.is_android():
+    if self.isandroid:
       if arch == 'arm7':
         archlibs += ['m_hard']
       else:
@@ -413,27 +524,35 @@ class ClangToolchain(toolchain.Toolchain):
 
   def make_libs(self, libs):
     if libs != None:
-      if self.target.is_windows():
-        return [lib + ".lib" for lib in libs]
-      return ['-l' + lib for lib in libs]
+      if self.iswindows:
+        return self.memoize_flags('libs', libs, lambda names: [lib + ".lib" for lib in names])
+      return self.memoize_flags('libs', libs, lambda names: ['-l' + lib for lib in names])
     return []
 
   def make_frameworks(self, frameworks):
     if frameworks != None:
-      return ['-framework ' + framework for framework in frameworks]
+      return self.memoize_flags('frameworks', frameworks, lambda names: ['-framework ' + framework for framework in names])
     return []
 
   def make_configlibpaths(self, config, arch, extralibpaths):
-    libpaths = [self.libpath, os.path.join(self.libpath, config)]
-    if not self.target.is_macos() and not self.target.is_ios():
-      libpaths += [os.path.join(self.libpath, arch)]
-      libpaths += [os.path.join(self.libpath, config, arch)]
+    #Apple universal targets pass the list of archs
+    key = (config, str(arch)) + tuple(extralibpaths or [])
+    return self.memoize_flags('configlibpaths', key, lambda key: self.build_configlibpaths(config, arch, extralibpaths))
+
+  def build_configlibpaths(self, config, arch, extralibpaths):
+    sep = os.sep
+    configpath = sep + config
+    libpath = self.libpath
+    libpaths = [libpath, libpath + configpath]
+    if not self.isapple:
+      archpath = sep + arch
+      libpaths += [libpath + archpath, libpath + configpath + archpath]
     if extralibpaths != None:
-      libpaths += [os.path.join(libpath, self.libpath) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, config) for libpath in extralibpaths]
-      if not self.target.is_macos() and not self.target.is_ios():
-        libpaths += [os.path.join(libpath, self.libpath, arch) for libpath in extralibpaths]
-        libpaths += [os.path.join(libpath, self.libpath, config, arch) for libpath in extralibpaths]
+      suffixes = [sep + libpath, sep + libpath + configpath]
+      if not self.isapple:
+        suffixes += [sep + libpath + archpath, sep + libpath + configpath + archpath]
+      for suffix in suffixes:
+        libpaths += [extralibpath + suffix for extralibpath in extralibpaths]
     return self.make_libpaths(libpaths)
 
   def cc_variables(self, config, arch, targettype, variables):
@@ -442,13 +561,16 @@ class ClangToolchain(toolchain.Toolchain):
       moreincludepaths = self.make_includepaths(variables['includepaths'])
       if not moreincludepaths == []:
         localvariables += [('moreincludepaths', moreincludepaths)]
-    carchflags = self.make_carchflags(arch, targettype)
+    carchflags = self.memoize_flags('carchflags', (str(arch), targettype), lambda key: self.make_carchflags(arch, targettype))
     if carchflags != []:
       localvariables += [('carchflags', carchflags)]
-    cconfigflags = self.make_cconfigflags(config, targettype)
+    cconfigflags = self.memoize_flags('cconfigflags', (config, targettype), lambda key: self.make_cconfigflags(config, targettype))
     if cconfigflags != []:
       localvariables += [('cconfigflags', cconfigflags)]
-    if self.target.is_android():
+    if config != 'debug' and self.cwarnflags:
+      #Warnings are only enforced in debug builds
+      localvariables += [('cwarnflags', '')]
+    if self.isandroid:
       localvariables += [('sysroot', self.android.make_sysroot_path(arch))]
     if 'defines' in variables:
       localvariables += [('cmoreflags', ['-D' + define for define in variables['defines']])]
@@ -456,13 +578,13 @@ class ClangToolchain(toolchain.Toolchain):
 
   def ar_variables(self, config, arch, targettype, variables):
     localvariables = []
-    ararchflags = self.make_ararchflags(arch, targettype)
+    ararchflags = self.memoize_flags('ararchflags', (str(arch), targettype), lambda key: self.make_ararchflags(arch, targettype))
     if ararchflags != []:
       localvariables += [('ararchflags', ararchflags)]
-    arconfigflags = self.make_arconfigflags(config, targettype)
+    arconfigflags = self.memoize_flags('arconfigflags', (config, targettype), lambda key: self.make_arconfigflags(config, targettype))
     if arconfigflags != []:
       localvariables += [('arconfigflags', arconfigflags)]
-    if self.target.is_android():
+    if self.isandroid:
       localvariables += [('toolchain', self.android.make_gcc_bin_path(arch))]
     return localvariables
 
@@ -470,10 +592,12 @@ class ClangToolchain(toolchain.Toolchain):
     if variables == None:
         variables = {}
     localvariables = []
-    linkarchflags = self.make_linkarchflags(arch, targettype, variables)
+    #Arch flags only depend on variables through support_lua
+    linkarchkey = (str(arch), targettype, bool(variables.get('support_lua')))
+    linkarchflags = self.memoize_flags('linkarchflags', linkarchkey, lambda key: self.make_linkarchflags(arch, targettype, variables))
     if linkarchflags != []:
       localvariables += [('linkarchflags', linkarchflags)]
-    linkconfigflags = self.make_linkconfigflags(config, targettype, variables)
+    linkconfigflags = self.memoize_flags('linkconfigflags', (config, targettype), lambda key: self.make_linkconfigflags(config, targettype, variables))
     if linkconfigflags != []:
       localvariables += [('linkconfigflags', linkconfigflags)]
     if 'libs' in variables:
@@ -491,11 +615,11 @@ class ClangToolchain(toolchain.Toolchain):
     if 'libpaths' in variables:
       libpaths = variables['libpaths']
     localvariables += [('configlibpaths', self.make_configlibpaths(config, arch, libpaths))]
-    if self.target.is_android():
+    if self.isandroid:
       localvariables += [('sysroot', self.android.make_sysroot_path(arch))]
-    archlibs = self.make_linkarchlibs(arch, targettype)
+    archlibs = self.memoize_flags('linkarchlibs', (str(arch), targettype), lambda key: self.make_libs(self.make_linkarchlibs(arch, targettype)))
     if archlibs != []:
-      localvariables += [('archlibs', self.make_libs(archlibs))]
+      localvariables += [('archlibs', archlibs)]
 
     if 'runtime' in variables and variables['runtime'] == 'c++':
       localvariables += [('link', self.cxxlinker)]
@@ -515,7 +639,7 @@ class ClangToolchain(toolchain.Toolchain):
     return writer.build(outfile, 'ar', infiles, implicit = self.implicit_deps(config, variables), variables = self.ar_variables(config, arch, targettype, variables))
 
   def builder_sharedlib(self, writer, config, arch, targettype, infiles, outfile, variables):
-    if self.target.is_windows():
+    if self.iswindows:
       return writer.build(outfile, 'dll', infiles, implicit = self.implicit_deps(config, variables), variables = self.link_variables(config, arch, targettype, variables))
     return writer.build(outfile, 'so', infiles, implicit = self.implicit_deps(config, variables), variables = self.link_variables(config, arch, targettype, variables))
 
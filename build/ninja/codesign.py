@@ -5,9 +5,8 @@
 import argparse
 import subprocess
 import os
-import time
-import shutil
 import json
+import sys
 
 parser = argparse.ArgumentParser(description = 'Codesign utility for Ninja builds')
 parser.add_argument('file', type=str,
@@ -55,6 +54,12 @@ parser.add_argument('--keypass', type=str,
 parser.add_argument('--jarsigner', type=str,
                     help = 'JAR signer (Android)',
                     default = 'jarsigner')
+parser.add_argument('--zipalign', type=str,
+                    help = 'Zipalign tool, align signed package when given (Android)',
+                    default = '')
+parser.add_argument('--jobs', type=int,
+                    help = 'Concurrent codesign processes for nested code (OSX/iOS)',
+                    default = os.cpu_count() or 1)
 parser.add_argument('--prefs', type=str,
                     help = 'Preferences file',
                     default = '')
@@ -67,16 +72,28 @@ androidprefs = {}
 iosprefs = {}
 macosprefs = {}
 
+#Command line options used as defaults for missing prefs
+androidkeys = ( 'tsacert', 'tsa', 'keystore', 'keystorepass', 'keyalias', 'keypass', 'jarsigner' )
+applekeys = ( ( 'organisation', 'organisation' ), ( 'bundleidentifier', 'bundle' ), ( 'provisioning', 'provisioning' ) )
+
+#Nested code that must be signed before the enclosing bundle
+nestedcode = ('.framework', '.dylib', '.appex', '.bundle', '.xpc')
+
 
 def parse_prefs( prefsfile ):
   global androidprefs
   global iosprefs
   global macosprefs
-  if not os.path.isfile( prefsfile ):
+  #No prefs file given, or a missing or empty one, leaves the command line defaults in place
+  if prefsfile == '':
+    return
+  try:
+    if os.stat( prefsfile ).st_size == 0:
+      return
+  except OSError:
     return
-  file = open( prefsfile, 'r' )
-  prefs = json.load( file )
-  file.close()
+  with open( prefsfile, 'rb' ) as file:
+    prefs = json.loads( file.read() )
   if 'android' in prefs:
     androidprefs = prefs['android']
   if 'ios' in prefs:
@@ -85,109 +102,210 @@ def parse_prefs( prefsfile ):
     macosprefs = prefs['macos']
 
 
+def xcrun( sdk, *args ):
+  #Lookups share the persistent, atomically written cache of the configure step
+  import xcode
+  xcode.xcrun_prefetch( sdk, [ args ] )
+  return xcode.xcrun( sdk, *args )
+
+
+def replace_placeholders( value, pattern, subs ):
+  if isinstance( value, str ):
+    return pattern.sub( lambda match: subs.get( match.group( 1 ), match.group( 0 ) ), value )
+  if isinstance( value, dict ):
+    return { key: replace_placeholders( item, pattern, subs ) for key, item in value.items() }
+  if isinstance( value, list ):
+    return [ replace_placeholders( item, pattern, subs ) for item in value ]
+  return value
+
+
+def bundle_fingerprint( bundle, signature, entitlements = None ):
+  import hashlib
+  #Path, size and mtime of every file so added, removed and replaced files all invalidate the signature
+  digest = hashlib.sha256()
+  digest.update( signature.encode() )
+  for root, dirs, files in os.walk( bundle ):
+    if '_CodeSignature' in dirs:
+      dirs.remove( '_CodeSignature' )
+    dirs.sort()
+    for name in sorted( files ):
+      path = os.path.join( root, name )
+      stat = os.stat( path )
+      digest.update( ( '\n' + os.path.relpath( path, bundle ) + ':' + str( stat.st_size ) + ':' + str( stat.st_mtime_ns ) ).encode() )
+  if entitlements:
+    with open( entitlements, 'rb' ) as file:
+      digest.update( file.read() )
+  return digest.hexdigest()
+
+
+def fingerprint_path():
+  return os.path.join( options.builddir, options.binname + '.codesign' )
+
+
+def is_signed( fingerprint ):
+  try:
+    with open( fingerprint_path(), 'r' ) as file:
+      return file.read() == fingerprint
+  except OSError:
+    return False
+
+
+def store_fingerprint( fingerprint ):
+  with open( fingerprint_path(), 'w' ) as file:
+    file.write( fingerprint )
+
+
+def touch_signature( paths ):
+  import time
+  #One timestamp for all paths, a missing signature seal fails the first utime and skips the rest
+  now = time.time_ns()
+  try:
+    for path in paths:
+      os.utime( path, ns = ( now, now ) )
+  except FileNotFoundError:
+    pass
+
+
+def find_nested_code( bundle ):
+  nested = {}
+  for root, dirs, files in os.walk( bundle ):
+    if '_CodeSignature' in dirs:
+      dirs.remove( '_CodeSignature' )
+    for name in dirs + files:
+      if name.endswith( nestedcode ):
+        path = os.path.join( root, name )
+        nested.setdefault( path.count( os.sep ), [] ).append( path )
+  return nested
+
+
+def codesign_bundle( command, bundle, entitlements = None, env = None ):
+  import concurrent.futures
+  #Sign inside-out, independent siblings at each depth are split across concurrent codesign invocations
+  nested = find_nested_code( bundle )
+  jobs = max( 1, options.jobs )
+  with concurrent.futures.ThreadPoolExecutor( max_workers = jobs ) as executor:
+    for depth in sorted( nested, reverse = True ):
+      paths = nested[depth]
+      batches = [ paths[i::jobs] for i in range( min( jobs, len( paths ) ) ) ]
+      results = list( executor.map( lambda batch: subprocess.call( command + batch, env = env ), batches ) )
+      #A failed nested sign must not be sealed into a signed bundle and fingerprinted as done
+      failed = [ result for result in results if result != 0 ]
+      if failed:
+        return failed[0]
+  if entitlements:
+    command = command + [ '--entitlements', entitlements ]
+  return subprocess.call( command + [ bundle ], env = env )
+
+
 def codesign_ios():
-  if not 'organisation' in iosprefs:
-    iosprefs['organisation'] = options.organisation
-  if not 'bundleidentifier' in iosprefs:
-    iosprefs['bundleidentifier'] = options.bundle
-  if not 'provisioning' in iosprefs:
-    iosprefs['provisioning'] = options.provisioning
-
-  sdkdir = subprocess.check_output( [ 'xcrun', '--sdk', 'iphoneos', '--show-sdk-path' ] ).strip()
+  #Target specific modules are only loaded for the target being signed
+  import plistlib
+  import re
+
+  for key, option in applekeys:
+    iosprefs.setdefault( key, getattr( options, option ) )
+
+  sdkdir = xcrun( 'iphoneos', '--show-sdk-path' )
   entitlements = os.path.join( sdkdir, 'Entitlements.plist' )
   plistpath = os.path.join( options.builddir, 'Entitlements.xcent' )
 
-  platformpath = subprocess.check_output( [ 'xcrun', '--sdk', 'iphoneos', '--show-sdk-platform-path' ] ).strip()
-  localpath = platformpath + "/Developer/usr/bin:/Applications/Xcode.app/Contents/Developer/usr/bin:/usr/bin:/bin:/usr/sbin:/sbin"
-  plutil = "PATH=" + localpath + " " + subprocess.check_output( [ 'xcrun', '--sdk', 'iphoneos', '-f', 'plutil' ] ).strip()
+  #plistlib reads both binary and XML plists, no need for a plutil conversion pass
+  with open( entitlements, 'rb' ) as plist_file:
+    plist = plistlib.load( plist_file )
 
-  shutil.copyfile( entitlements, plistpath )
-  os.system( plutil + ' -convert xml1 ' + plistpath )
+  #Any $(name) token is matched in one scan, names without a value are kept as is
+  subs = { 'AppIdentifierPrefix': iosprefs['organisation'] + '.',
+           'CFBundleIdentifier': iosprefs['bundleidentifier'],
+           'binname': options.binname }
+  pattern = re.compile( r'\$\(([^)]+)\)' )
+  plist = replace_placeholders( plist, pattern, subs )
+  if options.config != 'deploy':
+    plist['get-task-allow'] = True
 
-  f = open( plistpath, 'r' )
-  lines = [ line.strip( '\n\r' ) for line in f ]
-  f.close()
+  #Entitlements rarely change between builds, only replace the file when the content differs
+  content = plistlib.dumps( plist )
+  try:
+    with open( plistpath, 'rb' ) as plist_file:
+      unchanged = plist_file.read() == content
+  except OSError:
+    unchanged = False
+  if not unchanged:
+    with open( plistpath + '.tmp', 'wb' ) as plist_file:
+      plist_file.write( content )
+    os.replace( plistpath + '.tmp', plistpath )
 
-  for i in range( 0, len( lines ) ):
-    if lines[i].find( '$(AppIdentifierPrefix)' ) != -1:
-      lines[i] = lines[i].replace( '$(AppIdentifierPrefix)', iosprefs['organisation'] + '.' )
-    if lines[i].find( '$(CFBundleIdentifier)' ) != -1:
-      lines[i] = lines[i].replace( '$(CFBundleIdentifier)', iosprefs['bundleidentifier'] )
-    if lines[i].find( '$(binname)' ) != -1:
-      lines[i] = lines[i].replace( '$(binname)', options.binname )
+  signaturepath = os.path.join( options.file, '_CodeSignature' )
+  coderesources = os.path.join( signaturepath, 'CodeResources' )
 
-  with open( plistpath, 'w' ) as plist_file:
-    for line in lines:
-      if options.config != 'deploy' and line == '</dict>':
-        plist_file.write( '\t<key>get-task-allow</key>\n' )
-        plist_file.write( '\t<true/>\n' )
-      plist_file.write( line + '\n' )
-    plist_file.close()
+  #Bundle contents, entitlements and identity are unchanged since the last signing
+  if not is_signed( bundle_fingerprint( options.file, iosprefs['signature'], plistpath ) ):
+    if os.path.isfile( coderesources ):
+      os.remove( coderesources )
 
-  if os.path.isfile( os.path.join( options.file, '_CodeSignature', 'CodeResources' ) ):
-    os.remove( os.path.join( options.file, '_CodeSignature', 'CodeResources' ) )
+    result = codesign_bundle( [ '/usr/bin/codesign', '--force', '--sign', iosprefs['signature'] ], options.file, plistpath )
+    if result != 0:
+      sys.exit( result )
+    store_fingerprint( bundle_fingerprint( options.file, iosprefs['signature'], plistpath ) )
 
-  os.system( '/usr/bin/codesign --force --sign "' + iosprefs['signature'] + '" --entitlements ' + plistpath + ' ' + options.file )
-
-  if os.path.isfile( os.path.join( options.file, '_CodeSignature', 'CodeResources' ) ):
-    os.utime( os.path.join( options.file, '_CodeSignature', 'CodeResources' ), None )
-    os.utime( os.path.join( options.file, '_CodeSignature' ), None )
-    os.utime( options.file, None )
+  touch_signature( ( coderesources, signaturepath, options.file ) )
 
 
 def codesign_macos():
-  if not 'organisation' in macosprefs:
-    macosprefs['organisation'] = options.organisation
-  if not 'bundleidentifier' in macosprefs:
-    macosprefs['bundleidentifier'] = options.bundle
-  if not 'provisioning' in macosprefs:
-    macosprefs['provisioning'] = options.provisioning
-
-  codesign_allocate = subprocess.check_output( [ 'xcrun', '--sdk', 'macosx', '-f', 'codesign_allocate' ] ).strip()
-  sdkdir = subprocess.check_output( [ 'xcrun', '--sdk', 'macosx', '--show-sdk-path' ] ).strip()
-  entitlements = os.path.join( sdkdir, 'Entitlements.plist' )
+  for key, option in applekeys:
+    macosprefs.setdefault( key, getattr( options, option ) )
+
+  codesign_allocate = xcrun( 'macosx', '-f', 'codesign_allocate' )
+
+  contentpath = os.path.join( options.file, 'Contents' )
+  signaturepath = os.path.join( contentpath, '_CodeSignature' )
+  coderesources = os.path.join( signaturepath, 'CodeResources' )
 
-  if os.path.isfile( os.path.join( options.file, 'Contents', '_CodeSignature', 'CodeResources' ) ):
-    os.remove( os.path.join( options.file, 'Contents', '_CodeSignature', 'CodeResources' ) )
+  #Development builds only sign the executable and leave a stamp in place of the bundle seal
+  sealpath = coderesources
+  if options.config in ( 'debug', 'profile' ):
+    sealpath = os.path.join( options.builddir, options.binname + '.signed' )
 
-  if 'signature' in macosprefs:
-    os.system( 'export CODESIGN_ALLOCATE=' + codesign_allocate + '; /usr/bin/codesign --force --sign ' + macosprefs['signature'] + ' ' + options.file )
+  signature = macosprefs.get( 'signature' )
+  if signature is None or not is_signed( bundle_fingerprint( options.file, signature ) ):
+    if os.path.isfile( coderesources ):
+      os.remove( coderesources )
 
-  if os.path.isfile( os.path.join( options.file, 'Contents', '_CodeSignature', 'CodeResources' ) ):
-    os.utime( os.path.join( options.file, 'Contents', '_CodeSignature', 'CodeResources' ), None )
-    os.utime( os.path.join( options.file, 'Contents', '_CodeSignature' ), None )
-    os.utime( os.path.join( options.file, 'Contents' ), None )
-    os.utime( options.file, None )
+    if signature is not None:
+      env = dict( os.environ, CODESIGN_ALLOCATE = codesign_allocate )
+      command = [ '/usr/bin/codesign', '--force', '--sign', signature ]
+      if options.config in ( 'debug', 'profile' ):
+        #Local development builds only need a signed executable, skip hashing and sealing bundle resources
+        result = subprocess.call( command + [ os.path.join( contentpath, 'MacOS', options.binname ) ], env = env )
+      else:
+        result = codesign_bundle( command, options.file, env = env )
+      if result != 0:
+        sys.exit( result )
+      store_fingerprint( bundle_fingerprint( options.file, signature ) )
+
+  if sealpath != coderesources:
+    open( sealpath, 'a' ).close()
+    touch_signature( ( sealpath, contentpath, options.file ) )
+  else:
+    touch_signature( ( coderesources, signaturepath, contentpath, options.file ) )
 
 
 def codesign_android():
-  if not 'tsacert' in androidprefs:
-    androidprefs['tsacert'] = options.tsacert
-  if not 'tsa' in androidprefs:
-    androidprefs['tsa'] = options.tsa
-  if not 'keystore' in androidprefs:
-    androidprefs['keystore'] = options.keystore
-  if not 'keystorepass' in androidprefs:
-    androidprefs['keystorepass'] = options.keystorepass
-  if not 'keyalias' in androidprefs:
-    androidprefs['keyalias'] = options.keyalias
-  if not 'keypass' in androidprefs:
-    androidprefs['keypass'] = options.keypass
-  if not 'jarsigner' in androidprefs:
-    androidprefs['jarsigner'] = options.jarsigner
-
-  timestamp = ''
+  for key in androidkeys:
+    androidprefs.setdefault(key, getattr(options, key))
+
+  timestamp = []
   if androidprefs['tsacert'] != '':
-    timestamp = '-tsacert ' + androidprefs['tsacert']
+    timestamp = ['-tsacert', androidprefs['tsacert']]
   elif androidprefs['tsa'] != '':
-    timestamp = '-tsa ' + androidprefs['tsa']
+    timestamp = ['-tsa', androidprefs['tsa']]
 
-  proxy = ''
+  proxy = []
   if 'proxy' in androidprefs and androidprefs['proxy'] != '' and androidprefs['proxy'] != 'None':
-    proxy = androidprefs['proxy']
-    if proxy != '' and proxy != 'None':
+    proxyurl = androidprefs['proxy']
+    if proxyurl != '' and proxyurl != 'None':
+      import urllib.parse
       defstr = "-J-Dhttp.proxy"
-      url = urlparse.urlparse(proxy)
+      url = urllib.parse.urlparse(proxyurl)
       if url.scheme == 'https':
         defstr = "-J-Dhttps.proxy"
       host = url.netloc
@@ -199,16 +317,30 @@ def codesign_android():
         password, host = host.split('@', 1)
       if ':' in host:
         host, port = host.split(':', 1)
-      proxy = defstr + "Host=" + host
+      proxy = [defstr + "Host=" + host]
       if port != '':
-        proxy += " " + defstr + "Port=" + port
+        proxy += [defstr + "Port=" + port]
       if username != '':
-        proxy += " " + defstr + "User=" + username
+        proxy += [defstr + "User=" + username]
       if password != '':
-        proxy += " " + defstr + "Password=" + password
+        proxy += [defstr + "Password=" + password]
+
+  #Sign to an intermediate file and align into the final package in the same step
+  signedfile = options.file
+  if options.zipalign != '':
+    signedfile = options.file + '.unaligned'
+
+  signcmd = [androidprefs['jarsigner']] + timestamp + ['-sigalg', 'SHA1withRSA', '-digestalg', 'SHA1', '-keystore', androidprefs['keystore'], '-storepass', androidprefs['keystorepass'], '-keypass', androidprefs['keypass'], '-signedjar', signedfile, options.zipfile, androidprefs['keyalias']] + proxy
+  result = subprocess.call(signcmd)
+  if result != 0:
+    sys.exit(result)
 
-  signcmd = androidprefs['jarsigner'] + ' ' + timestamp + ' -sigalg SHA1withRSA -digestalg SHA1 -keystore ' + androidprefs['keystore'] + ' -storepass ' + androidprefs['keystorepass'] + ' -keypass ' + androidprefs['keypass'] + ' -signedjar ' + options.file + ' ' + options.zipfile + ' ' + androidprefs['keyalias'] + ' ' + proxy
-  os.system(signcmd)
+  if options.zipalign != '':
+    result = subprocess.call([options.zipalign, '-f', '4', signedfile, options.file])
+    if os.path.isfile(signedfile):
+      os.remove(signedfile)
+    if result != 0:
+      sys.exit(result)
 
 
 parse_prefs( options.prefs )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""Dex cache utility"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description = 'Dex cache utility for Ninja builds')
+parser.add_argument('input', type=str,
+                    help = 'Compiled class directory')
+parser.add_argument('--dex', type=str,
+                    help = 'Dex tool',
+                    default = 'dx')
+parser.add_argument('--output', type=str,
+                    help = 'Output dex file',
+                    default = '')
+parser.add_argument('--cachedir', type=str,
+                    help = 'Cache directory',
+                    default = os.getenv('DEXCACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ninja-dex')))
+options = parser.parse_args()
+
+
+def hash_inputs():
+  digest = hashlib.sha1()
+  digest.update(options.dex.encode())
+  if os.path.isfile(options.dex):
+    digest.update(str(os.path.getmtime(options.dex)).encode())
+  for root, dirs, files in os.walk(options.input):
+    dirs.sort()
+    for name in sorted(files):
+      path = os.path.join(root, name)
+      digest.update(os.path.relpath(path, options.input).replace('\\', '/').encode())
+      with open(path, 'rb') as file:
+        digest.update(file.read())
+  return digest.hexdigest()
+
+
+def unlink_output():
+  #Output may be a hard link into the cache, never write through it
+  if os.path.isfile(options.output):
+    os.remove(options.output)
+
+
+def fetch(cachefile):
+  unlink_output()
+  try:
+    os.link(cachefile, options.output)
+  except OSError:
+    shutil.copyfile(cachefile, options.output)
+  #Cached file keeps the time it was stored, the output must be newer than the rebuilt classes
+  os.utime(options.output, None)
+
+
+def store(cachefile):
+  try:
+    if not os.path.isdir(options.cachedir):
+      os.makedirs(options.cachedir)
+    tempfile = cachefile + '.' + str(os.getpid())
+    shutil.copyfile(options.output, tempfile)
+    os.replace(tempfile, cachefile)
+  except OSError:
+    pass
+
+
+cachefile = os.path.join(options.cachedir, hash_inputs() + '.dex')
+if os.path.isfile(cachefile):
+  fetch(cachefile)
+  sys.exit(0)
+
+unlink_output()
+result = subprocess.call([options.dex, '--dex', '--output', options.output, options.input])
+if result == 0:
+  store(cachefile)
+sys.exit(result)
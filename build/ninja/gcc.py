@@ -2,12 +2,20 @@
 
 """Ninja toolchain abstraction for GCC compiler suite"""
 
+import functools
 import os
 
 import toolchain
 
 class GCCToolchain(toolchain.Toolchain):
 
+  #Builder kind to ninja rule and variables method
+  builderrules = {'cc': ('cc', 'cc_variables'),
+                  'cxx': ('cxx', 'cc_variables'),
+                  'lib': ('ar', 'ar_variables'),
+                  'sharedlib': ('so', 'link_variables'),
+                  'bin': ('link', 'link_variables')}
+
   def initialize(self, project, archs, configs, includepaths, dependlibs, libpaths, variables, subninja):
     #Local variable defaults
     self.toolchain = ''
@@ -72,31 +80,37 @@ class GCCToolchain(toolchain.Toolchain):
 
     if not 'nowarning' in variables or not variables['nowarning']:
       self.cflags += self.cwarnflags
-    self.cxxflags = list(self.cflags)
-
-    self.cflags += ['-std=c11']
     if self.target.is_macos() or self.target.is_ios():
-      self.cxxflags += ['-std=c++14', '-stdlib=libc++']
+      self.cxxflags = self.cflags + ['-std=c++14', '-stdlib=libc++']
     else:
-      self.cxxflags += ['-std=gnu++14']
+      self.cxxflags = self.cflags + ['-std=gnu++14']
+    self.cflags += ['-std=c11']
 
     #Overrides
     self.objext = '.o'
 
     #Builders
-    self.builders['c'] = self.builder_cc
-    self.builders['cc'] = self.builder_cxx
-    self.builders['cpp'] = self.builder_cxx
-    self.builders['lib'] = self.builder_lib
+    self.builders['c'] = functools.partial(self.builder_rule, 'cc')
+    self.builders['cc'] = functools.partial(self.builder_rule, 'cxx')
+    self.builders['cpp'] = functools.partial(self.builder_rule, 'cxx')
+    self.builders['lib'] = functools.partial(self.builder_rule, 'lib')
     self.builders['multilib'] = self.builder_multicopy
-    self.builders['sharedlib'] = self.builder_sharedlib
+    self.builders['sharedlib'] = functools.partial(self.builder_rule, 'sharedlib')
     self.builders['multisharedlib'] = self.builder_multicopy
-    self.builders['bin'] = self.builder_bin
+    self.builders['bin'] = functools.partial(self.builder_rule, 'bin')
     self.builders['multibin'] = self.builder_multicopy
 
     #Setup target platform
     self.build_target_toolchain(self.target)
 
+    #Flags are final once the target platform is set up
+    self.cflags = tuple(self.cflags)
+    self.cxxflags = tuple(self.cxxflags)
+    self.cmoreflags = tuple(self.cmoreflags)
+    self.arflags = tuple(self.arflags)
+    self.linkflags = tuple(self.linkflags)
+    self.oslibs = tuple(self.oslibs)
+
   def name(self):
     return 'gcc'
 
@@ -160,24 +174,21 @@ class GCCToolchain(toolchain.Toolchain):
     self.oslibs = ['kernel32', 'user32', 'shell32', 'advapi32']
 
   def make_includepath(self, path):
-    if os.path.isabs(path) or self.subninja == '':
-      return self.path_escape(path)
-    if path == '.':
-      return self.path_escape(self.subninja)
-    return self.path_escape(os.path.join(self.subninja, path))
+    #Include paths repeat across every compile unit, resolve each one once
+    return self.memoize_flags('includepath', (path,), lambda key: self.path_escape(self.prefix_includepath(path)))
 
   def make_includepaths(self, includepaths):
     if not includepaths is None:
-      return ['-I' + self.make_includepath(path) for path in list(includepaths)]
-    return []
+      return ' '.join('-I' + self.make_includepath(path) for path in includepaths)
+    return ''
 
   def make_libpath(self, path):
     return self.path_escape(path)
 
   def make_libpaths(self, libpaths):
     if not libpaths is None:
-      return ['-L' + self.make_libpath(path) for path in libpaths]
-    return []
+      return ' '.join('-L' + self.make_libpath(path) for path in libpaths)
+    return ''
 
   def make_targetarchflags(self, arch, targettype):
     flags = []
@@ -238,33 +249,31 @@ class GCCToolchain(toolchain.Toolchain):
 
   def make_libs(self, libs):
     if libs != None:
-      return ['-l' + lib for lib in libs]
-    return []
+      return ' '.join('-l' + lib for lib in libs)
+    return ''
+
+  def make_libpath_variants(self, config, arch):
+    sep = os.sep
+    return [self.libpath, self.libpath + sep + arch, self.libpath + sep + config, self.libpath + sep + config + sep + arch]
 
   def make_configlibpaths(self, config, arch, extralibpaths):
-    libpaths = [
-      self.libpath,
-      os.path.join(self.libpath, arch),
-      os.path.join(self.libpath, config),
-      os.path.join(self.libpath, config, arch)
-      ]
+    variants = self.memoize_flags('libpathvariants', (config, arch), lambda key: self.make_libpath_variants(config, arch))
+    libpaths = list(variants)
     if extralibpaths != None:
-      libpaths += [os.path.join(libpath, self.libpath) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, arch) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, config) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, config, arch) for libpath in extralibpaths]
+      for variant in variants:
+        libpaths += [libpath + os.sep + variant for libpath in extralibpaths]
     return self.make_libpaths(libpaths)
 
   def cc_variables(self, config, arch, targettype, variables):
     localvariables = []
     if 'includepaths' in variables:
       moreincludepaths = self.make_includepaths(variables['includepaths'])
-      if not moreincludepaths == []:
+      if moreincludepaths != '':
         localvariables += [('moreincludepaths', moreincludepaths)]
-    carchflags = self.make_carchflags(arch, targettype)
+    carchflags = self.memoize_flags('carchflags', (arch, targettype), lambda key: self.make_carchflags(arch, targettype))
     if carchflags != []:
       localvariables += [('carchflags', carchflags)]
-    cconfigflags = self.make_cconfigflags(config, targettype)
+    cconfigflags = self.memoize_flags('cconfigflags', (config, targettype), lambda key: self.make_cconfigflags(config, targettype))
     if cconfigflags != []:
       localvariables += [('cconfigflags', cconfigflags)]
     if 'defines' in variables:
@@ -273,25 +282,25 @@ class GCCToolchain(toolchain.Toolchain):
 
   def ar_variables(self, config, arch, targettype, variables):
     localvariables = []
-    ararchflags = self.make_ararchflags(arch, targettype)
+    ararchflags = self.memoize_flags('ararchflags', (arch, targettype), lambda key: self.make_ararchflags(arch, targettype))
     if ararchflags != []:
       localvariables += [('ararchflags', ararchflags)]
-    arconfigflags = self.make_arconfigflags(config, targettype)
+    arconfigflags = self.memoize_flags('arconfigflags', (config, targettype), lambda key: self.make_arconfigflags(config, targettype))
     if arconfigflags != []:
       localvariables += [('arconfigflags', arconfigflags)]
     return localvariables
 
   def link_variables(self, config, arch, targettype, variables):
     localvariables = []
-    linkarchflags = self.make_linkarchflags(arch, targettype)
+    linkarchflags = self.memoize_flags('linkarchflags', (arch, targettype), lambda key: self.make_linkarchflags(arch, targettype))
     if linkarchflags != []:
       localvariables += [('linkarchflags', linkarchflags)]
-    linkconfigflags = self.make_linkconfigflags(config, targettype)
+    linkconfigflags = self.memoize_flags('linkconfigflags', (config, targettype), lambda key: self.make_linkconfigflags(config, targettype))
     if linkconfigflags != []:
       localvariables += [('linkconfigflags', linkconfigflags)]
     if 'libs' in variables:
       libvar = self.make_libs(variables['libs'])
-      if libvar != []:
+      if libvar != '':
         localvariables += [('libs', libvar)]
     libpaths = []
     if 'libpaths' in variables:
@@ -303,20 +312,9 @@ class GCCToolchain(toolchain.Toolchain):
 
     return localvariables
 
-  def builder_cc(self, writer, config, arch, targettype, infile, outfile, variables):
-    return writer.build(outfile, 'cc', infile, implicit = self.implicit_deps(config, variables), variables = self.cc_variables(config, arch, targettype, variables))
-
-  def builder_cxx(self, writer, config, arch, targettype, infile, outfile, variables):
-    return writer.build(outfile, 'cxx', infile, implicit = self.implicit_deps(config, variables), variables = self.cc_variables(config, arch, targettype, variables))
-
-  def builder_lib(self, writer, config, arch, targettype, infiles, outfile, variables):
-    return writer.build(outfile, 'ar', infiles, implicit = self.implicit_deps(config, variables), variables = self.ar_variables(config, arch, targettype, variables))
-
-  def builder_sharedlib(self, writer, config, arch, targettype, infiles, outfile, variables):
-    return writer.build(outfile, 'so', infiles, implicit = self.implicit_deps(config, variables), variables = self.link_variables(config, arch, targettype, variables))
-
-  def builder_bin(self, writer, config, arch, targettype, infiles, outfile, variables):
-    return writer.build(outfile, 'link', infiles, implicit = self.implicit_deps(config, variables), variables = self.link_variables(config, arch, targettype, variables))
+  def builder_rule(self, kind, writer, config, arch, targettype, infiles, outfile, variables):
+    rule, variablesfunc = self.builderrules[kind]
+    return writer.build(outfile, rule, infiles, implicit = self.implicit_deps(config, variables), variables = getattr(self, variablesfunc)(config, arch, targettype, variables))
 
 def create(host, target, toolchain):
   return GCCToolchain(host, target, toolchain)
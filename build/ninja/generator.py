@@ -3,14 +3,58 @@
 """Ninja build generator"""
 
 import argparse
+import atexit
+import hashlib
+import io
+import json
 import os
-import pipes
+import shlex
 import sys
 
 import platform
 import toolchain
 import syntax
 
+#Generated build files keyed by working directory and arguments, reused while their inputs are unchanged (set RPMALLOC_CONFIGURE_CACHE to enable)
+configurecachepath = os.path.join(os.path.expanduser('~'), '.cache', 'rpmalloc-configure')
+
+def file_stamp(path):
+  try:
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+  except OSError:
+    return [path]
+
+def git_paths():
+  #The version source follows git describe, which only changes with the checked out ref or the tags
+  gitpath = '.git'
+  if os.path.isfile(gitpath):
+    with open(gitpath, 'r') as gitfile:
+      gitpath = gitfile.read().strip()[len('gitdir: '):]
+  paths = [os.path.join(gitpath, 'HEAD'), os.path.join(gitpath, 'packed-refs'), os.path.join(gitpath, 'refs', 'tags')]
+  try:
+    with open(paths[0], 'r') as headfile:
+      head = headfile.read().strip()
+    if head.startswith('ref: '):
+      paths += [os.path.join(gitpath, head[len('ref: '):])]
+  except OSError:
+    pass
+  return paths
+
+def configure_inputs(project, buildprefs):
+  #Everything configure reads or writes that can be checked without spawning a process
+  scriptpath = os.path.dirname(os.path.abspath(__file__))
+  paths = [os.path.abspath(sys.argv[0]), 'build.json', os.path.join('build', 'ninja', 'build.json'), 'codesign.json', os.path.join(project, 'version.c')]
+  if buildprefs != '':
+    paths += [buildprefs]
+  paths += sorted(os.path.join(scriptpath, name) for name in os.listdir(scriptpath) if name.endswith('.py'))
+  try:
+    paths += git_paths()
+  except OSError:
+    pass
+  inputs = [sys.version, sorted(os.environ.items())] + [file_stamp(path) for path in paths]
+  return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
 class Generator(object):
   def __init__(self, project, includepaths = [], dependlibs = [], libpaths = [], variables = None):
     parser = argparse.ArgumentParser(description = 'Ninja build generator')
@@ -54,6 +98,17 @@ class Generator(object):
                         default = False)
     options = parser.parse_args()
 
+    #Reuse the build file from the last identical configure run, opt-in since toolchain changes outside the stamped inputs go unnoticed
+    self.cachefile = ''
+    if os.environ.get('RPMALLOC_CONFIGURE_CACHE'):
+      self.cachefile = os.path.join(configurecachepath, hashlib.sha1(json.dumps([os.getcwd()] + sys.argv).encode()).hexdigest() + '.json')
+      self.cacheproject = project
+      self.cachebuildprefs = options.buildprefs
+      content = self.read_cached_buildfile()
+      if content is not None:
+        self.write_buildfile_content(content)
+        sys.exit(0)
+
     self.project = project
     self.target = platform.Platform(options.target)
     self.host = platform.Platform(options.host)
@@ -65,8 +120,23 @@ class Generator(object):
     if not options.includepath is None:
       includepaths += options.includepath
 
-    buildfile = open('build.ninja', 'w')
-    self.writer = syntax.Writer(buildfile)
+    #Buffer the build file in memory and write it in one go once configure has finished
+    self.buildfile = io.StringIO()
+    self.writer = syntax.Writer(self.buildfile)
+    self.failed = False
+    excepthook = sys.excepthook
+    def fail(*args):
+      self.failed = True
+      excepthook(*args)
+    sys.excepthook = fail
+    #Toolchains report configure errors with sys.exit, which never reaches the excepthook
+    exit = sys.exit
+    def fail_exit(status = None):
+      if status is not None and status != 0:
+        self.failed = True
+      exit(status)
+    sys.exit = fail_exit
+    atexit.register(self.write_buildfile)
 
     self.writer.variable('ninja_required_version', '1.3')
     self.writer.newline()
@@ -79,10 +149,11 @@ class Generator(object):
     self.writer.variable('configure_target', self.target.platform)
     self.writer.variable('configure_host', self.host.platform)
 
-    env_keys = set(['CC', 'AR', 'LINK', 'CFLAGS', 'ARFLAGS', 'LINKFLAGS'])
-    configure_env = dict((key, os.environ[key]) for key in os.environ if key in env_keys)
+    env_keys = frozenset(['CC', 'AR', 'LINK', 'CFLAGS', 'ARFLAGS', 'LINKFLAGS'])
+    #Empty values select the same toolchain defaults as unset ones, leave them out
+    configure_env = {key: os.environ[key] for key in sorted(env_keys.intersection(os.environ)) if os.environ[key]}
     if configure_env:
-      config_str = ' '.join([key + '=' + pipes.quote(configure_env[key]) for key in configure_env])
+      config_str = ' '.join([key + '=' + shlex.quote(value) for key, value in configure_env.items()])
       self.writer.variable('configure_env', config_str + '$ ')
 
     if variables is None:
@@ -112,6 +183,48 @@ class Generator(object):
     if self.subninja == '':
       self.toolchain.write_rules(self.writer)
 
+  def read_cached_buildfile(self):
+    try:
+      with open(self.cachefile, 'r') as cachefile:
+        cache = json.load(cachefile)
+    except (OSError, ValueError):
+      return None
+    if cache.get('inputs') != configure_inputs(self.cacheproject, self.cachebuildprefs):
+      return None
+    return cache.get('buildfile')
+
+  def write_cached_buildfile(self, content):
+    #Inputs are stamped after configure has run, it writes the version source itself
+    try:
+      if not os.path.isdir(configurecachepath):
+        os.makedirs(configurecachepath)
+      tempfile = self.cachefile + '.' + str(os.getpid())
+      with open(tempfile, 'w') as cachefile:
+        json.dump({'inputs': configure_inputs(self.cacheproject, self.cachebuildprefs), 'buildfile': content}, cachefile)
+      os.replace(tempfile, self.cachefile)
+    except OSError:
+      pass
+
+  def write_buildfile(self):
+    if self.failed:
+      return
+    content = self.buildfile.getvalue()
+    self.write_buildfile_content(content)
+    if self.cachefile != '':
+      self.write_cached_buildfile(content)
+
+  def write_buildfile_content(self, content):
+    #Leave an identical build file untouched so ninja does not see a new mtime
+    try:
+      with open('build.ninja', 'r') as buildfile:
+        if buildfile.read() == content:
+          return
+    except OSError:
+      pass
+    with open('build.ninja.tmp', 'w') as buildfile:
+      buildfile.write(content)
+    os.replace('build.ninja.tmp', 'build.ninja')
+
   def target(self):
     return self.target
 
@@ -2,12 +2,95 @@
 
 """Ninja toolchain abstraction for Microsoft compiler suite"""
 
+import json
 import os
-import subprocess
 
 import toolchain
 import vslocate
 
+#Located toolchain and SDK keyed by the toolchain preferences
+located_toolchains = {}
+locatedattributes = ('toolchain', 'toolchain_version', 'sdkpath', 'sdkversion', 'sdkversionpath')
+locatedcachefile = os.path.join(os.path.expanduser('~'), '.cache', 'rpmalloc-msvc.json')
+
+def registry_values(key):
+  #Generate string values of a registry key read in process, nothing if the key does not exist or there is no registry
+  try:
+    import winreg
+  except ImportError:
+    return
+  hive, subkey = key.split('\\', 1)
+  hive = winreg.HKEY_LOCAL_MACHINE if hive == 'HKLM' else winreg.HKEY_CURRENT_USER
+  try:
+    handle = winreg.OpenKey(hive, subkey)
+  except OSError:
+    return
+  with handle:
+    index = 0
+    while True:
+      try:
+        name, value, valuetype = winreg.EnumValue(handle, index)
+      except OSError:
+        return
+      if valuetype == winreg.REG_SZ:
+        yield name, value.strip()
+      index += 1
+
+def registry_value(key, valuename):
+  return next((value for name, value in registry_values(key) if name == valuename), '')
+
+def is_version(version):
+  return all(part.isdigit() for part in version.split('.'))
+
+def version_key(version):
+  return tuple(int(part) for part in version.split('.'))
+
+def latest_tools_path(installpath):
+  tools_basepath = os.path.join(installpath, 'VC', 'Tools', 'MSVC')
+  tools_list = [item for item in os.listdir(tools_basepath) if os.path.isdir(os.path.join(tools_basepath, item))]
+  return os.path.join(tools_basepath, max(tools_list, key = version_key))
+
+def located_stamp(located):
+  #Installing or removing toolchain and SDK versions changes these directories
+  stamp = []
+  for path in [os.path.dirname(located.get('toolchain', '').rstrip('\\/')), os.path.join(located.get('sdkpath', ''), 'include')]:
+    try:
+      stamp += [os.path.getmtime(path)]
+    except OSError:
+      stamp += [0]
+  return stamp
+
+def read_located_cache():
+  if os.environ.get('RPMALLOC_MSVC_NOCACHE'):
+    return {}
+  try:
+    with open(locatedcachefile, 'r') as cachefile:
+      return json.load(cachefile)
+  except (OSError, ValueError):
+    return {}
+
+def read_located_toolchain(key):
+  located = read_located_cache().get(repr(key))
+  if located is None or located.get('stamp') != located_stamp(located):
+    return None
+  return located
+
+def write_located_toolchain(key, located):
+  #Keep looking for an SDK on every run until one is found
+  if os.environ.get('RPMALLOC_MSVC_NOCACHE') or located.get('sdkpath', '') == '':
+    return
+  cache = read_located_cache()
+  cache[repr(key)] = dict(located, stamp = located_stamp(located))
+  try:
+    if not os.path.isdir(os.path.dirname(locatedcachefile)):
+      os.makedirs(os.path.dirname(locatedcachefile))
+    tempfile = locatedcachefile + '.' + str(os.getpid())
+    with open(tempfile, 'w') as cachefile:
+      json.dump(cache, cachefile)
+    os.replace(tempfile, locatedcachefile)
+  except OSError:
+    pass
+
 class MSVCToolchain(toolchain.Toolchain):
 
   def initialize(self, project, archs, configs, includepaths, dependlibs, libpaths, variables, subninja):
@@ -127,21 +210,38 @@ class MSVCToolchain(toolchain.Toolchain):
     writer.newline()
 
   def build_toolchain(self):
+    #Registry and filesystem probing only depends on the preferences, reuse it for every instance
+    key = (self.toolchain, getattr(self, 'toolchain_version', ''), self.sdkpath, os.environ.get('VCToolsInstallDir', ''), os.environ.get('WindowsSdkDir', ''), os.environ.get('WindowsSDKVersion', ''))
+    #Results are also kept on disk until an installed toolchain or SDK directory changes (opt out with RPMALLOC_MSVC_NOCACHE)
+    located = located_toolchains.get(key) or read_located_toolchain(key)
+    if located is None:
+      includecount = len(self.includepaths)
+      self.locate_toolchain()
+      located = {name: getattr(self, name) for name in locatedattributes if hasattr(self, name)}
+      located['includepaths'] = self.includepaths[includecount:]
+      located_toolchains[key] = located
+      write_located_toolchain(key, located)
+    else:
+      located_toolchains[key] = located
+      for name in locatedattributes:
+        if name in located:
+          setattr(self, name, located[name])
+      self.includepaths += located['includepaths']
+
+  def locate_toolchain(self):
+    #Developer command prompts already point at the toolchain and SDK, only probe when they do not
+    if self.toolchain == '' and os.environ.get('VCToolsInstallDir', '') != '':
+      self.toolchain = os.environ['VCToolsInstallDir']
+      self.toolchain_version = os.environ.get('VisualStudioVersion', '15.0')
     if self.toolchain == '':
       installed_versions = vslocate.get_vs_installations()
       for versionstr, installpath in installed_versions:
         major_version = versionstr.split('.')[0]
         if int(major_version) >= 15:
-          tools_basepath = os.path.join(installpath, 'VC', 'Tools', 'MSVC')
-          tools_list = [item for item in os.listdir(tools_basepath) if os.path.isdir(os.path.join(tools_basepath, item))]
-          from distutils.version import StrictVersion
-          tools_list.sort(key=StrictVersion)
-          self.toolchain = os.path.join(tools_basepath, tools_list[-1])
+          self.toolchain = latest_tools_path(installpath)
           self.toolchain_version = major_version + ".0"
 
       if self.toolchain == '':
-        toolchain = ''
-        versions = ['16.0', '15.0', '14.0', '13.0', '12.0', '11.0', '10.0']
         keys = [
           'HKLM\\SOFTWARE\\Microsoft\\VisualStudio\\SxS\\VC7',
           'HKCU\\SOFTWARE\\Microsoft\\VisualStudio\\SxS\\VC7',
@@ -152,82 +252,76 @@ class MSVCToolchain(toolchain.Toolchain):
           'HKLM\\SOFTWARE\\Wow6432Node\\Microsoft\\VisualStudio\\SxS\\VS7',
           'HKCU\\SOFTWARE\\Wow6432Node\\Microsoft\\VisualStudio\\SxS\\VS7'
         ]
-        for version in versions:
-          for key in keys:
-            try:
-              query = subprocess.check_output(['reg', 'query', key, '/v', version ], stderr = subprocess.STDOUT).strip().splitlines()
-              if len(query) == 2:
-                toolchain = str(query[1]).split('REG_SZ')[-1].strip(" '\"\n\r\t")
-            except:
-              continue
-            if not toolchain == '':
-              if version == '15.0' or version == '16.0':
-                tools_basepath = os.path.join(toolchain, 'VC', 'Tools', 'MSVC')
-                tools_list = [item for item in os.listdir(tools_basepath) if os.path.isdir(os.path.join(tools_basepath, item))]
-                from distutils.version import StrictVersion
-                tools_list.sort(key=StrictVersion)
-                toolchain = os.path.join(tools_basepath, tools_list[-1])
-              self.toolchain = toolchain
-              self.toolchain_version = version
-              break
-          if not self.toolchain == '':
-            break
+        #Value names are the installed versions, first key listing a version wins
+        installed = {}
+        for key in keys:
+          for version, path in registry_values(key):
+            if is_version(version) and path != '':
+              installed.setdefault(version, path)
+        if installed:
+          version = max(installed, key = version_key)
+          toolchain = installed[version]
+          if version_key(version) >= (15,):
+            toolchain = latest_tools_path(toolchain)
+          self.toolchain = toolchain
+          self.toolchain_version = version
     if self.toolchain == '':
       raise Exception("Unable to locate any installed Visual Studio toolchain")
     self.includepaths += [os.path.join(self.toolchain, 'include')]
+    sdkpath = os.environ.get('WindowsSdkDir', '')
+    sdkversionpath = os.environ.get('WindowsSDKVersion', '').strip('\\/')
+    if self.sdkpath == '' and sdkpath != '' and sdkversionpath != '' and os.path.isdir(os.path.join(sdkpath, 'include', sdkversionpath, 'um')):
+      self.use_windows10_sdk(sdkpath, sdkversionpath)
     if self.sdkpath == '':
-      versions = ['v10.0', 'v8.1']
       keys = [
-        'HKLM\\SOFTWARE\\Microsoft\\Microsoft SDKs\\Windows',
-        'HKCU\\SOFTWARE\\Microsoft\\Microsoft SDKs\\Windows',
-        'HKLM\\SOFTWARE\\Wow6432Node\\Microsoft\\Microsoft SDKs\\Windows',
-        'HKCU\\SOFTWARE\\Wow6432Node\\Microsoft\\Microsoft SDKs\\Windows'
+        'HKLM\\SOFTWARE\\Microsoft\\Windows Kits\\Installed Roots',
+        'HKLM\\SOFTWARE\\Wow6432Node\\Microsoft\\Windows Kits\\Installed Roots'
       ]
-      include_path = 'include'
-      for version in versions:
-        for key in keys:
-          sdkpath = ''
-          try:
-            query = subprocess.check_output(['reg', 'query', key + '\\' + version, '/v', 'InstallationFolder'], stderr = subprocess.STDOUT).strip().splitlines()
-            if len(query) == 2:
-              sdkpath = str(query[1]).split('REG_SZ')[-1].strip(" '\"\n\r\t")
-              if not sdkpath == '' and version == 'v10.0':
-                base_path = sdkpath
-                sdkpath = ''
-                query = subprocess.check_output(['reg', 'query', key + '\\' + version, '/v', 'ProductVersion'], stderr = subprocess.STDOUT).strip().splitlines()
-                if len(query) == 2:
-                  version_path = str(query[1]).split('REG_SZ')[-1].strip(" '\"\n\r\t")
-                  if not version_path == '':
-                    sdkpath = base_path
-                    self.sdkversionpath = version_path
-                    versioned_include_path = os.path.join(include_path, self.sdkversionpath)
-                    if not os.path.exists(os.path.join(sdkpath, versioned_include_path)) and os.path.exists(os.path.join(sdkpath, versioned_include_path + '.0')):
-                      self.sdkversionpath = self.sdkversionpath + '.0'
-                      versioned_include_path = os.path.join(include_path, self.sdkversionpath)
-                    include_path = versioned_include_path
-          except subprocess.CalledProcessError as e:
-            continue
-          if not sdkpath == '':
-            self.includepaths += [
-              os.path.join(sdkpath, include_path, 'shared'),
-              os.path.join(sdkpath, include_path, 'um'),
-              os.path.join(sdkpath, include_path, 'winrt')
-            ]
-            if version == 'v10.0':
-              self.includepaths += [
-                os.path.join(sdkpath, include_path, 'ucrt')
-              ]
-            self.sdkpath = sdkpath
-            self.sdkversion = version
+      #Windows 10 SDK versions are the subdirectories of the kits root include directory
+      for key in keys:
+        sdkpath = registry_value(key, 'KitsRoot10')
+        include_basepath = os.path.join(sdkpath, 'include')
+        if sdkpath != '' and os.path.isdir(include_basepath):
+          versions = [item for item in os.listdir(include_basepath) if is_version(item) and os.path.isdir(os.path.join(include_basepath, item, 'um'))]
+          if versions:
+            self.use_windows10_sdk(sdkpath, max(versions, key = version_key))
             break
-        if not sdkpath == '':
+    if self.sdkpath == '':
+      keys = [
+        'HKLM\\SOFTWARE\\Microsoft\\Microsoft SDKs\\Windows\\v8.1',
+        'HKCU\\SOFTWARE\\Microsoft\\Microsoft SDKs\\Windows\\v8.1',
+        'HKLM\\SOFTWARE\\Wow6432Node\\Microsoft\\Microsoft SDKs\\Windows\\v8.1',
+        'HKCU\\SOFTWARE\\Wow6432Node\\Microsoft\\Microsoft SDKs\\Windows\\v8.1'
+      ]
+      for key in keys:
+        sdkpath = registry_value(key, 'InstallationFolder')
+        if sdkpath != '':
+          self.includepaths += [
+            os.path.join(sdkpath, 'include', 'shared'),
+            os.path.join(sdkpath, 'include', 'um'),
+            os.path.join(sdkpath, 'include', 'winrt')
+          ]
+          self.sdkpath = sdkpath
+          self.sdkversion = 'v8.1'
           break
     if self.toolchain != '' and not self.toolchain.endswith('/') and not self.toolchain.endswith('\\'):
       self.toolchain += os.sep
 
+  def use_windows10_sdk(self, sdkpath, sdkversionpath):
+    include_path = os.path.join('include', sdkversionpath)
+    self.includepaths += [
+      os.path.join(sdkpath, include_path, 'shared'),
+      os.path.join(sdkpath, include_path, 'um'),
+      os.path.join(sdkpath, include_path, 'winrt'),
+      os.path.join(sdkpath, include_path, 'ucrt')
+    ]
+    self.sdkpath = sdkpath
+    self.sdkversion = 'v10.0'
+    self.sdkversionpath = sdkversionpath
+
   def make_includepaths(self, includepaths):
     if not includepaths is None:
-      return ['/I' + self.path_escape(path) for path in list(includepaths)]
+      return self.memoize_flags('includepaths', includepaths, lambda paths: ['/I' + self.path_escape(path) for path in paths])
     return []
 
   def make_libpath(self, path):
@@ -235,10 +329,13 @@ class MSVCToolchain(toolchain.Toolchain):
 
   def make_libpaths(self, libpaths):
     if not libpaths is None:
-      return ['/LIBPATH:' + self.make_libpath(path) for path in libpaths]
+      return self.memoize_flags('libpaths', libpaths, lambda paths: ['/LIBPATH:' + self.make_libpath(path) for path in paths])
     return []
 
   def make_arch_toolchain_path(self, arch):
+    return self.memoize_flags('archtoolchainpath', (arch,), lambda key: self.build_arch_toolchain_path(arch))
+
+  def build_arch_toolchain_path(self, arch):
     if self.toolchain_version == '15.0' or self.toolchain_version == '16.0':
       if arch == 'x86-64':
         return os.path.join(self.toolchain, 'bin', 'HostX64', 'x64\\')
@@ -306,21 +403,19 @@ class MSVCToolchain(toolchain.Toolchain):
 
   def make_libs(self, libs):
     if libs != None:
-      return [lib + '.lib' for lib in libs]
+      return self.memoize_flags('libs', libs, lambda names: [lib + '.lib' for lib in names])
     return []
 
   def make_configlibpaths(self, config, arch, extralibpaths):
-    libpaths = [
-      self.libpath,
-      os.path.join(self.libpath, arch),
-      os.path.join(self.libpath, config),
-      os.path.join(self.libpath, config, arch)
-      ]
+    return self.memoize_flags('configlibpaths', (config, arch) + tuple(extralibpaths or []), lambda key: self.build_configlibpaths(config, arch, extralibpaths))
+
+  def build_configlibpaths(self, config, arch, extralibpaths):
+    sep = os.sep
+    variants = [self.libpath, self.libpath + sep + arch, self.libpath + sep + config, self.libpath + sep + config + sep + arch]
+    libpaths = list(variants)
     if extralibpaths != None:
-      libpaths += [os.path.join(libpath, self.libpath) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, arch) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, config) for libpath in extralibpaths]
-      libpaths += [os.path.join(libpath, self.libpath, config, arch) for libpath in extralibpaths]
+      for variant in variants:
+        libpaths += [libpath + sep + variant for libpath in extralibpaths]
     if self.sdkpath != '':
       if arch == 'x86':
         if self.toolchain_version == '15.0' or self.toolchain_version == '16.0':
@@ -352,10 +447,10 @@ class MSVCToolchain(toolchain.Toolchain):
         localvariables += [('moreincludepaths', moreincludepaths)]
     if 'modulepath' in variables:
       localvariables += [('pdbpath', os.path.join(variables['modulepath'], 'ninja.pdb'))]
-    carchflags = self.make_carchflags(arch, targettype)
+    carchflags = self.memoize_flags('carchflags', (arch, targettype), lambda key: self.make_carchflags(arch, targettype))
     if carchflags != []:
       localvariables += [('carchflags', carchflags)]
-    cconfigflags = self.make_cconfigflags(config, targettype)
+    cconfigflags = self.memoize_flags('cconfigflags', (config, targettype), lambda key: self.make_cconfigflags(config, targettype))
     if cconfigflags != []:
       localvariables += [('cconfigflags', cconfigflags)]
     if 'defines' in variables:
@@ -367,20 +462,20 @@ class MSVCToolchain(toolchain.Toolchain):
 
   def ar_variables(self, config, arch, targettype, variables):
     localvariables = [('toolchain', self.make_arch_toolchain_path(arch))]
-    ararchflags = self.make_ararchflags(arch, targettype)
+    ararchflags = self.memoize_flags('ararchflags', (arch, targettype), lambda key: self.make_ararchflags(arch, targettype))
     if ararchflags != []:
       localvariables += [('ararchflags', ararchflags)]
-    arconfigflags = self.make_arconfigflags(config, targettype)
+    arconfigflags = self.memoize_flags('arconfigflags', (config, targettype), lambda key: self.make_arconfigflags(config, targettype))
     if arconfigflags != []:
       localvariables += [('arconfigflags', arconfigflags)]
     return localvariables
 
   def link_variables(self, config, arch, targettype, variables):
     localvariables = [('toolchain', self.make_arch_toolchain_path(arch))]
-    linkarchflags = self.make_linkarchflags(arch, targettype)
+    linkarchflags = self.memoize_flags('linkarchflags', (arch, targettype), lambda key: self.make_linkarchflags(arch, targettype))
     if linkarchflags != []:
       localvariables += [('linkarchflags', linkarchflags)]
-    linkconfigflags = self.make_linkconfigflags(config, targettype)
+    linkconfigflags = self.memoize_flags('linkconfigflags', (config, targettype), lambda key: self.make_linkconfigflags(config, targettype))
     if linkconfigflags != []:
       localvariables += [('linkconfigflags', linkconfigflags)]
     if 'modulepath' in variables:
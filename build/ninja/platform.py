@@ -7,33 +7,36 @@ import sys
 def supported_platforms():
   return [ 'windows', 'linux', 'macos', 'bsd', 'ios', 'android', 'raspberrypi', 'tizen', 'sunos', 'haiku' ]
 
+#Canonical platform names and common sys.platform values resolve with a single lookup
+platformnames = {
+  'windows': 'windows', 'linux': 'linux', 'macos': 'macos', 'bsd': 'bsd', 'ios': 'ios', 'android': 'android',
+  'raspberrypi': 'raspberrypi', 'tizen': 'tizen', 'sunos': 'sunos', 'haiku': 'haiku',
+  'win32': 'windows', 'linux2': 'linux', 'darwin': 'macos'
+}
+
+#Ordered prefixes for remaining platform strings (versioned names like freebsd12 or sunos5)
+platformprefixes = (
+  ('linux', 'linux'), ('darwin', 'macos'), ('macos', 'macos'), ('win', 'windows'), ('dragonfly', 'bsd'),
+  ('ios', 'ios'), ('android', 'android'), ('raspberry', 'raspberrypi'), ('tizen', 'tizen'), ('sunos', 'sunos'),
+  ('haiku', 'haiku')
+)
+
 class Platform(object):
   def __init__(self, platform):
     self.platform = platform
     if self.platform is None:
       self.platform = sys.platform
-    if self.platform.startswith('linux'):
-      self.platform = 'linux'
-    elif self.platform.startswith('darwin'):
-      self.platform = 'macos'
-    elif self.platform.startswith('macos'):
-      self.platform = 'macos'
-    elif self.platform.startswith('win'):
-      self.platform = 'windows'
-    elif 'bsd' in self.platform or self.platform.startswith('dragonfly'):
-      self.platform = 'bsd'
-    elif self.platform.startswith('ios'):
-      self.platform = 'ios'
-    elif self.platform.startswith('android'):
-      self.platform = 'android'
-    elif self.platform.startswith('raspberry'):
-      self.platform = 'raspberrypi'
-    elif self.platform.startswith('tizen'):
-      self.platform = 'tizen'
-    elif self.platform.startswith('sunos'):
-      self.platform = 'sunos'
-    elif self.platform.startswith('haiku'):
-      self.platform = 'haiku'
+    name = platformnames.get(self.platform)
+    if name is None:
+      if 'bsd' in self.platform:
+        name = 'bsd'
+      else:
+        for prefix, prefixname in platformprefixes:
+          if self.platform.startswith(prefix):
+            name = prefixname
+            break
+    if not name is None:
+      self.platform = name
 
   def platform(self):
     return self.platform
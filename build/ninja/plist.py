@@ -3,33 +3,52 @@
 """PList utility"""
 
 import argparse
+import functools
 import os
 import subprocess
 import re
 import unicodedata
 
+valuepattern = re.compile( '^.*>(.*)<.*$' )
+varpattern = re.compile( r'\$(?:\(([A-Za-z0-9_:]+)\)|\{([A-Za-z0-9_:]+)\})' )
+
+@functools.lru_cache( maxsize = None )
 def normalize_char(c):
+  #Plain ASCII has no accents to strip, skip the unicode database
+  if ord( c ) < 0x80:
+    return c
   try:
-    cname = unicodedata.name( unicode(c) )
+    cname = unicodedata.name( c )
     cname = cname[:cname.index( ' WITH' )]
     return unicodedata.lookup( cname )
   except ( ValueError, KeyError ):
     return c
 
+@functools.lru_cache( maxsize = None )
 def normalize_string(s):
     return ''.join( normalize_char(c) for c in s )
 
-def replace_var( str, var, val ):
-  if str.find( '$(' + var + ')' ) != -1:
-    return str.replace( '$(' + var + ')', val )
-  if str.find( '${' + var + '}' ) != -1:
-    return str.replace( '${' + var + '}', val )
-  return str
+def start_query( args ):
+  try:
+    return subprocess.Popen( args, stdout = subprocess.PIPE )
+  except FileNotFoundError:
+    return None
+
+def query_output( query ):
+  if query is None:
+    return ''
+  output = query.communicate()[0]
+  if query.returncode != 0:
+    raise subprocess.CalledProcessError( query.returncode, query.args )
+  return output.decode().strip()
+
+def replace_vars( str, values ):
+  return varpattern.sub( lambda match: values.get( match.group( 1 ) or match.group( 2 ), match.group( 0 ) ), str )
 
 
 parser = argparse.ArgumentParser( description = 'PList utility for Ninja builds' )
 parser.add_argument( 'files',
-                     metavar = 'file', type=file, nargs='+',
+                     metavar = 'file', type=str, nargs='+',
                      help = 'Source plist file' )
 parser.add_argument( '--exename', type=str,
                      help = 'Executable name',
@@ -63,86 +82,98 @@ if not options.deploymenttarget:
   else:
     options.deploymenttarget = '6.0'
 
-buildversion = subprocess.check_output( [ 'sw_vers', '-buildVersion' ] ).strip()
-
-#Merge inputs using first file as base
+#Tool queries run concurrently with each other and the plist processing, output is collected where needed.
+#Only Apple targets query the host tools, and hosts without them skip the build version and binary conversion
+sdk = 'iphoneos'
+buildversionquery = None
+platformpathquery = None
+plutilquery = None
+if options.target in [ 'macos', 'ios' ]:
+  buildversionquery = start_query( [ 'sw_vers', '-buildVersion' ] )
+  platformpathquery = start_query( [ 'xcrun', '--sdk', sdk, '--show-sdk-platform-path' ] )
+  plutilquery = start_query( [ 'xcrun', '--sdk', sdk, '-f', 'plutil' ] )
+
+#Merge inputs using first file as base, body of each merged dict goes before the first closing dict tag
 lines = []
-for f in options.files:
+for path in options.files:
+  with open( path, 'r' ) as f:
+    mergelines = f.read().splitlines()
   if lines == []:
-    lines += [ line.strip( '\n\r' ) for line in f ]
-  else:
-    mergelines = [ line.strip( '\n\r' ) for line in f ]
-    for i in range( 0, len( mergelines ) ):
-      if re.match( '^<dict/>$', mergelines[i] ):
-        break
-      if re.match( '^<dict>$', mergelines[i] ):
-        for j in range( 0, len( lines ) ):
-          if re.match( '^</dict>$', lines[j] ):
-            for k in range( i+1, len( mergelines ) ):
-              if re.match( '^</dict>$', mergelines[k] ):
-                break
-              lines.insert( j+(k-(i+1)), mergelines[k] )
-            break
-        break
-
-#Parse input plist to get package type and signature
+    lines = mergelines
+    continue
+  for i, line in enumerate( mergelines ):
+    if line == '<dict/>':
+      break
+    if line == '<dict>':
+      end = i + 1
+      while end < len( mergelines ) and mergelines[end] != '</dict>':
+        end += 1
+      if '</dict>' in lines:
+        j = lines.index( '</dict>' )
+        lines[j:j] = mergelines[i+1:end]
+      break
+
+#Substitute build variables and locate the lines to edit in a single pass,
+#package type and signature are parsed from the unsubstituted input
+identifier = normalize_string( options.exename ).lower()
+buildvariables = { 'EXECUTABLE_NAME': options.exename,
+                   'PRODUCT_NAME': options.prodname,
+                   'PRODUCT_NAME:rfc1034identifier': identifier,
+                   'PRODUCT_NAME:c99extidentifier': identifier.replace( '-', '_' ).replace( '.', '_' ),
+                   'IOS_DEPLOYMENT_TARGET': options.deploymenttarget,
+                   'MACOSX_DEPLOYMENT_TARGET': options.deploymenttarget }
 bundle_package_type = 'APPL'
 bundle_signature = '????'
+dictline = None
+identifierline = None
+signatureline = None
 
-for i in range( 0, len( lines ) ):
-  if 'CFBundlePackageType' in lines[i]:
-    match = re.match( '^.*>(.*)<.*$', lines[i+1] )
+for i, line in enumerate( lines ):
+  if 'CFBundlePackageType' in line:
+    match = valuepattern.match( lines[i+1] )
     if match:
       bundle_package_type = match.group(1)
-  if 'CFBundleSignature' in lines[i]:
-    match = re.match( '^.*>(.*)<.*$', lines[i+1] )
+  if 'CFBundleSignature' in line:
+    match = valuepattern.match( lines[i+1] )
     if match:
       bundle_signature = match.group(1)
+  line = lines[i] = replace_vars( line, buildvariables )
+  if dictline is None and line == '<dict>':
+    dictline = i
+  if identifierline is None and 'CFBundleIdentifier' in line:
+    identifierline = i
+  if signatureline is None and 'CFBundleSignature' in line:
+    signatureline = i
 
 #Write package type and signature to PkgInfo in output path
 with open( os.path.join( os.path.dirname( options.output ), 'PkgInfo' ), 'w' ) as pkginfo_file:
   pkginfo_file.write( bundle_package_type + bundle_signature )
-  pkginfo_file.close()
-
-#insert os version
-for i in range( 0, len( lines ) ):
-  if re.match( '^<dict>$', lines[i] ):
-    lines.insert( i+1, '\t<key>BuildMachineOSBuild</key>' )
-    lines.insert( i+2, '\t<string>' + buildversion + '</string>' )
-    break
-
-#replace build variables name
-for i in range( 0, len( lines ) ):
-  lines[i] = replace_var( lines[i], 'EXECUTABLE_NAME', options.exename )
-  lines[i] = replace_var( lines[i], 'PRODUCT_NAME', options.prodname )
-  lines[i] = replace_var( lines[i], 'PRODUCT_NAME:rfc1034identifier', normalize_string( options.exename ).lower() )
-  lines[i] = replace_var( lines[i], 'PRODUCT_NAME:c99extidentifier', normalize_string( options.exename ).lower().replace( '-', '_' ).replace( '.', '_' ) )
-  lines[i] = replace_var( lines[i], 'IOS_DEPLOYMENT_TARGET', options.deploymenttarget )
-  lines[i] = replace_var( lines[i], 'MACOSX_DEPLOYMENT_TARGET', options.deploymenttarget )
 
 #replace bundle identifier if given
-if not options.bundle is None and options.bundle != '':
-  for i in range( 0, len( lines ) ):
-    if lines[i].find( 'CFBundleIdentifier' ) != -1:
-      lines[i+1] = '\t<string>' + normalize_string( options.bundle ) + '</string>'
-      break
-
-#add supported platform, minimum os version and requirements
-if options.target == 'ios':
-  for i in range( 0, len( lines ) ):
-    if 'CFBundleSignature' in lines[i]:
-      lines.insert( i+2,  '\t<key>CFBundleSupportedPlatforms</key>' )
-      lines.insert( i+3,  '\t<array>' )
-      lines.insert( i+4,  '\t\t<string>iPhoneOS</string>' )
-      lines.insert( i+5,  '\t</array>' )
-      lines.insert( i+6,  '\t<key>MinimumOSVersion</key>' )
-      lines.insert( i+7,  '\t<string>6.0</string>' )
-      lines.insert( i+8,  '\t<key>UIDeviceFamily</key>' )
-      lines.insert( i+9,  '\t<array>' )
-      lines.insert( i+10, '\t\t<integer>1</integer>' )
-      lines.insert( i+11, '\t\t<integer>2</integer>' )
-      lines.insert( i+12, '\t</array>' )
-      break
+if options.bundle and not identifierline is None:
+  lines[identifierline+1] = '\t<string>' + normalize_string( options.bundle ) + '</string>'
+
+#insert os version, and supported platform, minimum os version and requirements for ios,
+#last position first so earlier line indices stay valid
+inserts = []
+buildversion = query_output( buildversionquery )
+if not dictline is None and buildversion != '':
+  inserts += [ ( dictline + 1, [ '\t<key>BuildMachineOSBuild</key>',
+                                 '\t<string>' + buildversion + '</string>' ] ) ]
+if options.target == 'ios' and not signatureline is None:
+  inserts += [ ( signatureline + 2, [ '\t<key>CFBundleSupportedPlatforms</key>',
+                                      '\t<array>',
+                                      '\t\t<string>iPhoneOS</string>',
+                                      '\t</array>',
+                                      '\t<key>MinimumOSVersion</key>',
+                                      '\t<string>6.0</string>',
+                                      '\t<key>UIDeviceFamily</key>',
+                                      '\t<array>',
+                                      '\t\t<integer>1</integer>',
+                                      '\t\t<integer>2</integer>',
+                                      '\t</array>' ] ) ]
+for index, insertlines in sorted( inserts, key = lambda insert: insert[0], reverse = True ):
+  lines[index:index] = insertlines
 
 #add build info
 #<key>DTCompiler</key>
@@ -164,15 +195,12 @@ if options.target == 'ios':
 
 #write final Info.plist in output path
 with open( options.output, 'w' ) as plist_file:
-  for line in lines:
-    #print lines[i]
-    plist_file.write( line + '\n' )
-  plist_file.close()
+  plist_file.write( '\n'.join( lines ) + '\n' )
 
-#run plutil -convert binary1
-sdk = 'iphoneos'
-platformpath = subprocess.check_output( [ 'xcrun', '--sdk', sdk, '--show-sdk-platform-path' ] ).strip()
+#run plutil -convert binary1, directly with the SDK tool path instead of through a shell
+platformpath = query_output( platformpathquery )
 localpath = platformpath + "/Developer/usr/bin:/Applications/Xcode.app/Contents/Developer/usr/bin:/usr/bin:/bin:/usr/sbin:/sbin"
-plutil = "PATH=" + localpath + " " + subprocess.check_output( [ 'xcrun', '--sdk', sdk, '-f', 'plutil' ] ).strip()
-os.system( plutil + ' -convert binary1 ' + options.output )
+plutil = query_output( plutilquery )
+if plutil != '':
+  subprocess.call( [ plutil, '-convert', 'binary1', options.output ], env = dict( os.environ, PATH = localpath ) )
 
@@ -27,10 +27,21 @@ class Writer(object):
     def variable(self, key, value, indent=0):
         if value is None:
             return
-        if isinstance(value, list):
+        if isinstance(value, (list, tuple)):
             value = ' '.join(filter(None, value))  # Filter out empty strings.
         self._line('%s = %s' % (key, value), indent)
 
+    def variables(self, variables, indent=0):
+        """Write a list of (key, value) pairs with a single output write."""
+        lines = []
+        for key, value in variables:
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = ' '.join(filter(None, value))  # Filter out empty strings.
+            lines.append(self._wrap('%s = %s' % (key, value), indent))
+        self.output.write(''.join(lines))
+
     def pool(self, name, depth):
         self._line('pool %s' % name)
         self.variable('depth', depth, indent=1)
@@ -106,6 +117,11 @@ class Writer(object):
 
     def _line(self, text, indent=0):
         """Write 'text' word-wrapped at self.width characters."""
+        self.output.write(self._wrap(text, indent))
+
+    def _wrap(self, text, indent=0):
+        """Return 'text' word-wrapped at self.width characters."""
+        lines = []
         leading_space = '  ' * indent
         while len(leading_space) + len(text) > self.width:
             # The text is too wide; wrap if possible.
@@ -132,13 +148,14 @@ class Writer(object):
                 # Give up on breaking.
                 break
 
-            self.output.write(leading_space + text[0:space] + ' $\n')
+            lines.append(leading_space + text[0:space] + ' $\n')
             text = text[space+1:]
 
             # Subsequent lines are continuations, so indent them.
             leading_space = '  ' * (indent+2)
 
-        self.output.write(leading_space + text + '\n')
+        lines.append(leading_space + text + '\n')
+        return ''.join(lines)
 
     def _as_list(self, input):
         if input is None:
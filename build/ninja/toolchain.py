@@ -4,6 +4,7 @@
 
 import sys
 import os
+import functools
 import subprocess
 import platform
 import random
@@ -16,8 +17,12 @@ import xcode
 
 
 def check_output(args):
-  import subprocess
-  return subprocess.check_output(args).decode().strip()
+  return subprocess.check_output(args, encoding = 'utf-8').strip()
+
+def get_machine():
+  if hasattr(os, 'uname'):
+    return os.uname()[4]
+  return check_output(['uname', '-m'])
 
 def supported_toolchains():
   return ['msvc', 'gcc', 'clang', 'intel']
@@ -40,8 +45,23 @@ def make_toolchain(host, target, toolchain):
   toolchainmodule = __import__(toolchain, globals(), locals())
   return toolchainmodule.create(host, target, toolchain)
 
+#Parsed preference files keyed by path, mtime and size
+parsed_prefs = {}
+
+#Preference keys mapped to toolchain attribute and value conversion
+prefattributes = {
+  'monolithic': ('build_monolithic', get_boolean_flag),
+  'coverage': ('build_coverage', get_boolean_flag),
+  'lto': ('build_lto', get_boolean_flag),
+  'support_lua': ('support_lua', get_boolean_flag),
+  'python': ('python', None)
+}
+
+@functools.lru_cache(maxsize = None)
 def make_pathhash(path, targettype):
-  return '-' + hex(zlib.adler32((path + targettype).encode()) & 0xffffffff)[2:-1]
+  #Memoized since every source is hashed again for each config and arch
+  #zlib crc32 uses hardware CRC instructions where available, all eight hex digits are kept
+  return '-' + format(zlib.crc32((path + targettype).encode()) & 0xffffffff, '08x')
 
 class Toolchain(object):
   def __init__(self, host, target, toolchain):
@@ -100,17 +120,20 @@ class Toolchain(object):
       self.cdcmd = lambda p: 'cmd /C cd ' + p
       self.mkdircmd = lambda p: 'cmd /C (IF NOT exist ' + p + ' (mkdir ' + p + '))'
       self.copycmd = lambda p, q: 'cmd /C (IF exist ' + q + ' (del /F /Q ' + q + ')) & copy /Y ' + p + ' ' + q + ' > NUL'
+      self.copyfilescmd = lambda p, q: 'cmd /C (for %f in (' + p + ') do copy /Y %f ' + q + ' > NUL)'
     else:
       self.rmcmd = lambda p: 'rm -f ' + p
       self.cdcmd = lambda p: 'cd ' + p
       self.mkdircmd = lambda p: 'mkdir -p ' + p
       self.copycmd = lambda p, q: 'cp -f ' + p + ' ' + q
+      self.copyfilescmd = lambda p, q: 'cp -f ' + p + ' ' + q
 
     #Target functionality
     if target.is_android():
       self.android = android.make_target(self, host, target)
     if target.is_macos() or target.is_ios():
       self.xcode = xcode.make_target(self, host, target)
+    self.subtargets = [subtarget for subtarget in (self.android, self.xcode) if subtarget != None]
 
     #Builders
     self.builders = {}
@@ -118,6 +141,9 @@ class Toolchain(object):
     #Paths created
     self.paths_created = {}
 
+    #Memoized flag lists
+    self.flagcache = {}
+
   def initialize_subninja(self, path):
     self.subninja = path
 
@@ -134,7 +160,7 @@ class Toolchain(object):
     if self.target.is_windows():
       self.archs = ['x86-64']
     elif self.target.is_linux() or self.target.is_bsd() or self.target.is_sunos() or self.target.is_haiku():
-      localarch = subprocess.check_output(['uname', '-m']).decode().strip()
+      localarch = get_machine()
       if localarch == 'x86_64' or localarch == 'amd64':
         self.archs = ['x86-64']
       elif localarch == 'i686':
@@ -161,12 +187,17 @@ class Toolchain(object):
     self.configs = ['debug', 'release']#, 'profile', 'deploy']
 
   def initialize_toolchain(self):
-    if self.android != None:
-      self.android.initialize_toolchain()
-    if self.xcode != None:
-      self.xcode.initialize_toolchain()
+    for subtarget in self.subtargets:
+      subtarget.initialize_toolchain()
 
   def initialize_depends(self, dependlibs):
+    #Single listing of sibling directories, header is only probed in directories that exist
+    siblings = set()
+    if dependlibs:
+      try:
+        siblings = set(entry.name for entry in os.scandir('..') if entry.is_dir())
+      except OSError:
+        pass
     for lib in dependlibs:
       includepath = ''
       libpath = ''
@@ -175,7 +206,7 @@ class Toolchain(object):
         os.path.join('..', lib + '_lib')
       ]
       for testpath in testpaths:
-        if os.path.isfile(os.path.join(testpath, lib, lib + '.h')):
+        if os.path.basename(testpath) in siblings and os.path.isfile(os.path.join(testpath, lib, lib + '.h')):
           if self.subninja != '':
             basepath, _ = os.path.split(self.subninja)
             _, libpath = os.path.split(testpath)
@@ -192,10 +223,8 @@ class Toolchain(object):
           self.depend_libpaths += [libpath]
 
   def build_toolchain(self):
-    if self.android != None:
-      self.android.build_toolchain()
-    if self.xcode != None:
-      self.xcode.build_toolchain()
+    for subtarget in self.subtargets:
+      subtarget.build_toolchain()
 
   def parse_default_variables(self, variables):
     if not variables:
@@ -225,28 +254,24 @@ class Toolchain(object):
       self.read_prefs(self.buildprefs)
 
   def read_prefs(self, filename):
-    if not os.path.isfile( filename ):
+    #One stat both checks for the file and keys the parsed prefs shared by all toolchain instances
+    try:
+      stat = os.stat(filename)
+    except OSError:
       return
-    file = open(filename, 'r')
-    prefs = json.load(file)
-    file.close()
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    prefs = parsed_prefs.get(key)
+    if prefs is None:
+      with open(filename, 'r') as file:
+        prefs = parsed_prefs[key] = json.load(file)
     self.parse_prefs(prefs)
 
   def parse_prefs(self, prefs):
-    if 'monolithic' in prefs:
-      self.build_monolithic = get_boolean_flag(prefs['monolithic'])
-    if 'coverage' in prefs:
-      self.build_coverage = get_boolean_flag( prefs['coverage'] )
-    if 'lto' in prefs:
-      self.build_lto = get_boolean_flag( prefs['lto'] )
-    if 'support_lua' in prefs:
-      self.support_lua = get_boolean_flag(prefs['support_lua'])
-    if 'python' in prefs:
-      self.python = prefs['python']
-    if self.android != None:
-      self.android.parse_prefs(prefs)
-    if self.xcode != None:
-      self.xcode.parse_prefs(prefs)
+    for key, (attribute, convert) in prefattributes.items():
+      if key in prefs:
+        setattr(self, attribute, convert(prefs[key]) if convert else prefs[key])
+    for subtarget in self.subtargets:
+      subtarget.parse_prefs(prefs)
 
   def archs(self):
     return self.archs
@@ -270,19 +295,16 @@ class Toolchain(object):
     writer.variable('buildpath', self.buildpath)
     writer.variable('target', self.target.platform)
     writer.variable('config', '')
-    if self.android != None:
-      self.android.write_variables(writer)
-    if self.xcode != None:
-      self.xcode.write_variables(writer)
+    for subtarget in self.subtargets:
+      subtarget.write_variables(writer)
 
   def write_rules(self, writer):
     writer.pool('serial_pool', 1)
     writer.rule('copy', command = self.copycmd('$in', '$out'), description = 'COPY $in -> $out')
+    writer.rule('copyfiles', command = self.copyfilescmd('$in', '$outpath'), description = 'COPY $in -> $outpath')
     writer.rule('mkdir', command = self.mkdircmd('$out'), description = 'MKDIR $out')
-    if self.android != None:
-      self.android.write_rules(writer)
-    if self.xcode != None:
-      self.xcode.write_rules(writer)
+    for subtarget in self.subtargets:
+      subtarget.write_rules(writer)
 
   def cdcmd(self):
     return self.cdcmd
@@ -302,29 +324,42 @@ class Toolchain(object):
   def copy(self, writer, src, dst, implicit = None, order_only = None):
     return writer.build(dst, 'copy', src, implicit = implicit, order_only = order_only)
 
+  def copy_files(self, writer, srcs, dstpath, implicit = None, order_only = None):
+    dsts = [os.path.join(dstpath, os.path.basename(src)) for src in srcs]
+    return writer.build(dsts, 'copyfiles', srcs, implicit = implicit, order_only = order_only, variables = [('outpath', dstpath)])
+
   def builder_multicopy(self, writer, config, archs, targettype, infiles, outpath, variables):
     output = []
     rootdir = self.mkdir(writer, outpath)
+    archset = set(archs)
+    copies = []
     for file in infiles:
       path, targetfile = os.path.split(file)
       archpath = outpath
       #Find which arch we are copying from and append to target path
       #unless on generic arch targets, then re-add if not self.target.is_generic():
-      for arch in archs:
-        remainpath, subdir = os.path.split(path)
-        while remainpath != '':
-          if subdir == arch:
-            archpath = os.path.join(outpath, arch)
-            break
-          remainpath, subdir = os.path.split(remainpath)
-        if remainpath != '':
-          break
+      arch = next((subdir for subdir in reversed(os.path.normpath(path).split(os.sep)) if subdir in archset), None)
+      if arch != None:
+        archpath = os.path.join(outpath, arch)
       targetpath = os.path.join(archpath, targetfile)
       if os.path.normpath(file) != os.path.normpath(targetpath):
-        archdir = self.mkdir(writer, archpath, implicit = rootdir)
-        output += self.copy(writer, file, targetpath, order_only = archdir)
+        copies += [(file, targetpath, archpath)]
+    #One mkdir per distinct arch directory, shared by all copies into it
+    archdirs = {}
+    for _, _, archpath in copies:
+      if not archpath in archdirs:
+        archdirs[archpath] = self.mkdir(writer, archpath, implicit = rootdir)
+    for file, targetpath, archpath in copies:
+      output += self.copy(writer, file, targetpath, order_only = archdirs[archpath])
     return output
 
+  def memoize_flags(self, kind, values, make):
+    key = (kind, tuple(values))
+    flags = self.flagcache.get(key)
+    if flags is None:
+      flags = self.flagcache[key] = make(key[1])
+    return flags
+
   def path_escape(self, path):
     if self.host.is_windows():
       return "\"%s\"" % path.replace("\"", "'")
@@ -341,7 +376,9 @@ class Toolchain(object):
     return os.path.join(self.subninja, path)
 
   def prefix_includepaths(self, includepaths):
-    return [self.prefix_includepath(path) for path in includepaths]
+    #Same include lists recur for every module, config and arch, callers may extend the returned list
+    prefixed = self.memoize_flags(('prefixincludepaths', self.subninja), includepaths, lambda paths: [self.prefix_includepath(path) for path in paths])
+    return list(prefixed)
 
   def list_per_config(self, config_dicts, config):
     if config_dicts is None:
@@ -392,7 +429,7 @@ class Toolchain(object):
       libpaths = []
     sourcevariables = (variables or {}).copy()
     sourcevariables.update({
-                     'includepaths': self.depend_includepaths + self.prefix_includepaths(list(includepaths))})
+                     'includepaths': self.depend_includepaths + self.prefix_includepaths(includepaths)})
     if not libs and dependlibs != None:
       libs = []
     if dependlibs != None:
@@ -405,13 +442,26 @@ class Toolchain(object):
                      'frameworks': frameworks})
     self.module = module
     self.buildtarget = binfile
+    #Source inputs and object names do not depend on config or arch, resolve them once
+    sep = os.sep
+    compiles = []
+    for name in sources:
+      if os.path.isabs(name):
+        infile = name
+        objname = os.path.splitext(os.path.basename(name))[0] + make_pathhash(infile, nodetype) + self.objext
+      else:
+        infile = os.path.join(basepath, module, name)
+        objname = os.path.splitext(name)[0] + make_pathhash(infile, nodetype) + self.objext
+        if self.subninja != '':
+          infile = os.path.join(self.subninja, infile)
+      compiles += [(infile, objname)]
+    modulesubpath = os.path.join(basepath, decoratedmodule)
     for config in configs:
       archnodes = []
       built[config] = []
       for arch in self.archs:
         objs = []
-        buildpath = os.path.join('$buildpath', config, arch)
-        modulepath = os.path.join(buildpath, basepath, decoratedmodule)
+        modulepath = '$buildpath' + sep + config + sep + arch + sep + modulesubpath
         sourcevariables['modulepath'] = modulepath
         nodevariables['modulepath'] = modulepath
         #Make per-arch-and-config list of final implicit deps, including dependent libs
@@ -422,18 +472,10 @@ class Toolchain(object):
           dep_implicit_deps += self.make_implicit_deps(outpath, arch, config, dependlibs)
           nodevariables['implicit_deps'] = dep_implicit_deps
         #Compile all sources
-        for name in sources:
-          if os.path.isabs(name):
-            infile = name
-            outfile = os.path.join(modulepath, os.path.splitext(os.path.basename(name))[0] + make_pathhash(infile, nodetype) + self.objext)
-          else:
-            infile = os.path.join(basepath, module, name)
-            outfile = os.path.join(modulepath, os.path.splitext(name)[0] + make_pathhash(infile, nodetype) + self.objext)
-            if self.subninja != '':
-              infile = os.path.join(self.subninja, infile)
-          objs += self.compile_file(writer, config, arch, nodetype, infile, outfile, sourcevariables)
+        for infile, objname in compiles:
+          objs += self.compile_file(writer, config, arch, nodetype, infile, modulepath + sep + objname, sourcevariables)
         #Build arch node (per-config-and-arch binary)
-        archoutpath = os.path.join(modulepath, binfile)
+        archoutpath = modulepath + sep + binfile
         archnodes += self.compile_node(writer, nodetype, config, arch, objs, archoutpath, nodevariables)
       #Build final config node (per-config binary)
       built[config] += self.compile_node(writer, multitype, config, self.archs, archnodes, os.path.join(outpath, config), None)
@@ -2,24 +2,31 @@
 
 """Version utility"""
 
+import functools
 import subprocess
 import os
 import sys
 
+@functools.lru_cache( maxsize = 1 )
+def git_describe():
+  #Spawned once per process, every toolchain and library shares the result
+  gitcmd = 'git'
+  if sys.platform.startswith('win'):
+    gitcmd = 'git.exe'
+  try:
+    return subprocess.check_output( [ gitcmd, 'describe', '--long' ], stderr = subprocess.STDOUT ).strip().decode()
+  except Exception:
+    return None
+
 def generate_version_string(libname):
 
   version_numbers = []
   tokens = []
 
-  gitcmd = 'git'
-  if sys.platform.startswith('win'):
-    gitcmd = 'git.exe'
-  try:
-    git_version = subprocess.check_output( [ gitcmd, 'describe', '--long' ], stderr = subprocess.STDOUT ).strip()
-    tokens = git_version.decode().split( '-' )
+  git_version = git_describe()
+  if not git_version is None:
+    tokens = git_version.split( '-' )
     version_numbers = tokens[0].split( '.' )
-  except Exception:
-    pass
 
   version_major = "0"
   version_minor = "0"
@@ -55,25 +62,30 @@ version_t
 
 def read_version_string(input_path):
   try:
-    file = open( os.path.join( input_path, 'version.c' ), "r" )
-    str = file.read()
-    file.close()
+    with open( os.path.join( input_path, 'version.c' ), "rb" ) as file:
+      return file.read()
   except IOError:
-    str = ""
-  return str
+    return b""
 
 def write_version_string(output_path, str):
-  file = open( os.path.join( output_path, 'version.c' ), "w" )
-  file.write( str )
-  file.close
+  path = os.path.join( output_path, 'version.c' )
+  with open( path + '.tmp', "wb" ) as file:
+    file.write( str )
+  os.replace( path + '.tmp', path )
 
 def generate_version(libname, output_path):
   generated = generate_version_string(libname)
   if generated == None:
     return
-  previous = read_version_string(output_path)
+  generated = generated.encode()
+
+  #A size mismatch already means the file changed, only read it back when the sizes agree
+  try:
+    unchanged = os.path.getsize( os.path.join( output_path, 'version.c' ) ) == len( generated ) and read_version_string(output_path) == generated
+  except OSError:
+    unchanged = False
 
-  if generated != previous:
+  if not unchanged:
     write_version_string(output_path, generated)
 
 if __name__ == "__main__":
@@ -4,8 +4,31 @@
 
 import os
 import ctypes
+import functools
+import json
+import subprocess
 
+@functools.lru_cache(maxsize=1)
 def get_vs_installations():
+    #Setup configuration DLL is queried in process, vswhere covers machines where it cannot be loaded
+    installations = get_setup_installations()
+    if not installations:
+        installations = get_vswhere_installations() or []
+    return installations
+
+def get_vswhere_installations():
+    """Query installations with a single vswhere JSON listing, None if vswhere is not available"""
+    vswhere_path = os.path.join(os.environ.get("ProgramFiles(x86)", "C:\\Program Files (x86)"), "Microsoft Visual Studio", "Installer", "vswhere.exe")
+    if not os.path.isfile(vswhere_path):
+        return None
+    try:
+        output = subprocess.check_output([vswhere_path, '-products', '*', '-format', 'json', '-utf8'])
+        instances = json.loads(output.decode('utf-8'))
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+    return [(instance['installationVersion'], instance['installationPath']) for instance in instances]
+
+def get_setup_installations():
 
     class ISetupInstanceVTable(ctypes.Structure):
         """Class matching VisualStudio Setup package ISetupInstance vtable"""
@@ -122,8 +145,11 @@ def get_vs_installations():
     setup_instance = ctypes.POINTER(ISetupInstance)()
     fetched = ctypes.c_int(0)
 
+    #Resolve vtable functions once, instances normally share a single vtable
+    next = enum_setup_instances.contents.vtable.contents.Next
+    instance_functions = {}
+
     while True:
-        next = enum_setup_instances.contents.vtable.contents.Next
         result = next(enum_setup_instances, 1, ctypes.byref(setup_instance), ctypes.byref(fetched))
         if result == 1 or fetched == 0:
             break
@@ -134,8 +160,11 @@ def get_vs_installations():
         version = ctypes.c_wchar_p()
         path = ctypes.c_wchar_p()
         
-        get_installation_version = setup_instance.contents.vtable.contents.GetInstallationVersion
-        get_installation_path = setup_instance.contents.vtable.contents.GetInstallationPath
+        vtable = setup_instance.contents.vtable
+        functions = instance_functions.get(ctypes.addressof(vtable.contents))
+        if functions is None:
+            functions = instance_functions[ctypes.addressof(vtable.contents)] = (vtable.contents.GetInstallationVersion, vtable.contents.GetInstallationPath)
+        get_installation_version, get_installation_path = functions
 
         result = get_installation_version(setup_instance, ctypes.byref(version))
         if result != 0:
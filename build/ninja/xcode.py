@@ -2,20 +2,128 @@
 
 """Ninja toolchain abstraction for XCode toolchain"""
 
+import concurrent.futures
+import functools
+import json
 import os
 import subprocess
 
 import toolchain
 import syntax
 
+#Results of xcrun queries keyed by sdk and arguments, shared with the clang toolchain
+xcrun_results = {}
+xcruncachefile = os.path.join(os.path.expanduser('~'), '.cache', 'rpmalloc-xcrun.json')
+platformdirs = {'macosx': 'MacOSX.platform', 'iphoneos': 'iPhoneOS.platform'}
+xibmoduletable = str.maketrans('-.', '__')
+
+@functools.lru_cache(maxsize = 1)
+def developer_dir():
+  #Active developer directory, the xcode-select link is read without spawning a process
+  path = os.environ.get('DEVELOPER_DIR', '')
+  if path == '' and os.path.islink('/var/db/xcode_select_link'):
+    path = os.path.realpath('/var/db/xcode_select_link')
+  if path == '':
+    try:
+      path = toolchain.check_output(['xcode-select', '-p'])
+    except (OSError, subprocess.CalledProcessError):
+      path = ''
+  return path
+
+def xcrun_stamp():
+  #Switching or updating Xcode changes the developer directory or its version plist
+  developerdir = developer_dir()
+  try:
+    return [developerdir, os.path.getmtime(os.path.join(os.path.dirname(developerdir), 'version.plist'))]
+  except OSError:
+    return [developerdir, 0]
+
+def use_xcrun_cache():
+  return developer_dir() != '' and not os.environ.get('RPMALLOC_XCRUN_NOCACHE')
+
+@functools.lru_cache(maxsize = 1)
+def read_xcrun_cache():
+  #Results from previous runs with the same Xcode, read once per process
+  if not use_xcrun_cache():
+    return {}
+  try:
+    with open(xcruncachefile, 'r') as cachefile:
+      cache = json.load(cachefile)
+  except (OSError, ValueError):
+    return {}
+  if cache.get('stamp') != xcrun_stamp():
+    return {}
+  return {tuple(key): value for key, value in cache.get('results', [])}
+
+def write_xcrun_cache():
+  if not use_xcrun_cache():
+    return
+  try:
+    if not os.path.isdir(os.path.dirname(xcruncachefile)):
+      os.makedirs(os.path.dirname(xcruncachefile))
+    #Keep lookups made by other runs, such as another sdk or the codesign step
+    results = dict(read_xcrun_cache())
+    results.update(xcrun_results)
+    tempfile = xcruncachefile + '.' + str(os.getpid())
+    with open(tempfile, 'w') as cachefile:
+      json.dump({'stamp': xcrun_stamp(), 'results': [[list(key), value] for key, value in results.items()]}, cachefile)
+    os.replace(tempfile, xcruncachefile)
+  except OSError:
+    pass
+
+def xcrun(sdk, *args):
+  key = (sdk,) + args
+  if key not in xcrun_results:
+    xcrun_results[key] = read_xcrun_cache().get(key) or toolchain.check_output(['xcrun', '--sdk', sdk] + list(args))
+  return xcrun_results[key]
+
+def xcrun_prefetch(sdk, queries):
+  #Queries are independent lookups, run the ones not cached in this or a previous run concurrently
+  cached = read_xcrun_cache()
+  for query in queries:
+    key = (sdk,) + query
+    if key in cached and not key in xcrun_results:
+      xcrun_results[key] = cached[key]
+  pending = [query for query in queries if not (sdk,) + query in xcrun_results]
+  if len(pending) > 1:
+    with concurrent.futures.ThreadPoolExecutor(max_workers = len(pending)) as executor:
+      list(executor.map(lambda query: xcrun(sdk, *query), pending))
+  elif pending:
+    xcrun(sdk, *pending[0])
+  if pending:
+    write_xcrun_cache()
+
+def platform_path(sdk):
+  #Platforms are plain directories in the developer directory, xcrun is only asked for unexpected layouts
+  developerdir = developer_dir()
+  if developerdir != '' and sdk in platformdirs:
+    path = os.path.join(developerdir, 'Platforms', platformdirs[sdk])
+    if os.path.isdir(path):
+      return path
+  return xcrun(sdk, '--show-sdk-platform-path')
+
+def developer_tool_path(tool):
+  #Tools in the developer or default toolchain directory need no xcrun lookup, unless another toolchain is selected
+  developerdir = developer_dir()
+  if developerdir == '' or os.environ.get('TOOLCHAINS'):
+    return ''
+  for toolpath in [os.path.join(developerdir, 'usr', 'bin'), os.path.join(developerdir, 'Toolchains', 'XcodeDefault.xctoolchain', 'usr', 'bin')]:
+    if os.path.isfile(os.path.join(toolpath, tool)):
+      return os.path.join(toolpath, tool)
+  return ''
+
 def make_target(toolchain, host, target):
   return XCode(toolchain, host, target)
 
 class XCode(object):
+  #Settings read from both default variables and the per-platform preferences
+  prefkeys = ('deploymenttarget', 'organisation', 'bundleidentifier', 'provisioning')
+
   def __init__(self, toolchain, host, target):
     self.toolchain = toolchain
     self.host = host
     self.target = target
+    self.bundletoolswritten = False
 
   def initialize_toolchain(self):
     self.organisation = ''
@@ -29,32 +137,27 @@ class XCode(object):
   def build_toolchain(self):
     if self.target.is_macos():
       sdk = 'macosx'
-      deploytarget = 'MACOSX_DEPLOYMENT_TARGET=' + self.deploymenttarget
     elif self.target.is_ios():
       sdk = 'iphoneos'
-      deploytarget = 'IPHONEOS_DEPLOYMENT_TARGET=' + self.deploymenttarget
-
-    platformpath = toolchain.check_output(['xcrun', '--sdk', sdk, '--show-sdk-platform-path'])
-    localpath = platformpath + "/Developer/usr/bin:/Applications/Xcode.app/Contents/Developer/usr/bin:/usr/bin:/bin:/usr/sbin:/sbin"
 
-    self.plist = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'plutil'])
-    self.xcassets = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'actool'])
-    self.xib = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'ibtool'])
-    self.dsymutil = "PATH=" + localpath + " " + toolchain.check_output(['xcrun', '--sdk', sdk, '-f', 'dsymutil'])
+    #Commands read the deployment target from the build file variable, preferences parsed later still apply
+    self.sdk = sdk
+    platformpath = platform_path(sdk)
+    self.localpath = platformpath + "/Developer/usr/bin:/Applications/Xcode.app/Contents/Developer/usr/bin:/usr/bin:/bin:/usr/sbin:/sbin"
 
     self.plistcmd = 'build/ninja/plist.py --exename $exename --prodname $prodname --bundle $bundleidentifier --target $target --deploymenttarget $deploymenttarget --output $outpath $in'
     if self.target.is_macos():
       self.xcassetscmd = 'mkdir -p $outpath && $xcassets --output-format human-readable-text --output-partial-info-plist $outplist' \
-                         ' --app-icon AppIcon --launch-image LaunchImage --platform macosx --minimum-deployment-target ' + self.deploymenttarget + \
+                         ' --app-icon AppIcon --launch-image LaunchImage --platform macosx --minimum-deployment-target $deploymenttarget' \
                          ' --target-device mac --compress-pngs --compile $outpath $in >/dev/null'
-      self.xibcmd = '$xib --target-device mac --module $module --minimum-deployment-target ' + self.deploymenttarget + \
+      self.xibcmd = '$xib --target-device mac --module $module --minimum-deployment-target $deploymenttarget' \
                     ' --output-partial-info-plist $outplist --auto-activate-custom-fonts' \
                     ' --output-format human-readable-text --compile $outpath $in'
     elif self.target.is_ios():
       self.xcassetscmd = 'mkdir -p $outpath && $xcassets --output-format human-readable-text --output-partial-info-plist $outplist' \
-                         ' --app-icon AppIcon --launch-image LaunchImage --platform iphoneos --minimum-deployment-target ' + self.deploymenttarget + \
+                         ' --app-icon AppIcon --launch-image LaunchImage --platform iphoneos --minimum-deployment-target $deploymenttarget' \
                          ' --target-device iphone --target-device ipad --compress-pngs --compile $outpath $in >/dev/null'
-      self.xibcmd = '$xib --target-device iphone --target-device ipad --module $module --minimum-deployment-target ' + self.deploymenttarget + \
+      self.xibcmd = '$xib --target-device iphone --target-device ipad --module $module --minimum-deployment-target $deploymenttarget' \
                     ' --output-partial-info-plist $outplist --auto-activate-custom-fonts' \
                     ' --output-format human-readable-text --compile $outpath $in &> /dev/null '
     self.dsymutilcmd = '$dsymutil $in -o $outpath'
@@ -68,42 +171,20 @@ class XCode(object):
     else:
       iterator = iter(variables)
     for key, val in iterator:
-      if key == 'deploymenttarget':
-        self.deploymenttarget = val
-      if key == 'organisation':
-        self.organisation = val
-      if key == 'bundleidentifier':
-        self.bundleidentifier = val
-      if key == 'provisioning':
-        self.provisioning = val
+      if key in self.prefkeys:
+        setattr(self, key, val)
 
   def parse_prefs(self, prefs):
-    if self.target.is_ios() and 'ios' in prefs:
-      iosprefs = prefs['ios']
-      if 'deploymenttarget' in iosprefs:
-        self.deploymenttarget = iosprefs['deploymenttarget']
-      if 'organisation' in iosprefs:
-        self.organisation = iosprefs['organisation']
-      if 'bundleidentifier' in iosprefs:
-        self.bundleidentifier = iosprefs['bundleidentifier']
-      if 'provisioning' in iosprefs:
-        self.provisioning = iosprefs['provisioning']
-    elif self.target.is_macos() and 'macos' in prefs:
-      macosprefs = prefs['macos']
-      if 'deploymenttarget' in macosprefs:
-        self.deploymenttarget = macosprefs['deploymenttarget']
-      if 'organisation' in macosprefs:
-        self.organisation = macosprefs['organisation']
-      if 'bundleidentifier' in macosprefs:
-        self.bundleidentifier = macosprefs['bundleidentifier']
-      if 'provisioning' in macosprefs:
-        self.provisioning = macosprefs['provisioning']
+    targetprefs = {}
+    if self.target.is_ios():
+      targetprefs = prefs.get('ios', {})
+    elif self.target.is_macos():
+      targetprefs = prefs.get('macos', {})
+    for key in self.prefkeys:
+      if key in targetprefs:
+        setattr(self, key, targetprefs[key])
 
   def write_variables(self, writer):
-    writer.variable('plist', self.plist)
-    writer.variable('xcassets', self.xcassets)
-    writer.variable('xib', self.xib)
-    writer.variable('dsymutil', self.dsymutil)
     writer.variable('bundleidentifier', syntax.escape(self.bundleidentifier))
     writer.variable('deploymenttarget', self.deploymenttarget)
 
@@ -114,6 +195,17 @@ class XCode(object):
     writer.rule('xib', command = self.xibcmd, description = 'XIB $outpath')
     writer.rule('codesign', command = self.codesigncmd, description = 'CODESIGN $outpath')
 
+  def write_bundle_tools(self, writer):
+    #Bundle tools are only located once an app is built, library and test builds never need them
+    if self.bundletoolswritten:
+      return
+    self.bundletoolswritten = True
+    tools = [('plist', 'plutil'), ('xcassets', 'actool'), ('xib', 'ibtool'), ('dsymutil', 'dsymutil')]
+    toolpaths = {tool: developer_tool_path(tool) for _, tool in tools}
+    xcrun_prefetch(self.sdk, [('-f', tool) for tool, toolpath in toolpaths.items() if toolpath == ''])
+    for name, tool in tools:
+      writer.variable(name, "PATH=" + self.localpath + " " + (toolpaths[tool] or xcrun(self.sdk, '-f', tool)))
+
   def make_bundleidentifier(self, binname):
     return self.bundleidentifier.replace('$(binname)', binname)
 
@@ -123,79 +215,94 @@ class XCode(object):
     builtres = []
     builtsym = []
 
+    self.write_bundle_tools(writer)
+
     #Paths
     builddir = os.path.join('$buildpath', config, 'app', binname)
     configpath = os.path.join(outpath, config)
     apppath = os.path.join(configpath, binname + '.app')
     dsympath = os.path.join(outpath, config, binname + '.dSYM')
+    cwd = os.getcwd()
+
+    #macOS bundles keep everything in Contents and resources in a subdirectory, iOS bundles are flat
+    if self.target.is_macos():
+      contentpath = os.path.join(apppath, 'Contents')
+      resourcepath = os.path.join(contentpath, 'Resources')
+    else:
+      contentpath = apppath
+      resourcepath = apppath
 
     #Extract debug symbols from universal binary
     dsymcontentpath = os.path.join(dsympath, 'Contents')
-    builtsym = writer.build([os.path.join(dsymcontentpath, 'Resources', 'DWARF', binname), os.path.join(dsymcontentpath, 'Resources', 'DWARF' ), os.path.join(dsymcontentpath, 'Resources'), os.path.join(dsymcontentpath, 'Info.plist'), dsymcontentpath, dsympath], 'dsymutil', archbins[config], variables = [('outpath', dsympath)])
+    dsymresourcepath = os.path.join(dsymcontentpath, 'Resources')
+    dwarfpath = os.path.join(dsymresourcepath, 'DWARF')
+    builtsym = writer.build([os.path.join(dwarfpath, binname), dwarfpath, dsymresourcepath, os.path.join(dsymcontentpath, 'Info.plist'), dsymcontentpath, dsympath], 'dsymutil', archbins[config], variables = [('outpath', dsympath)])
 
     #Copy final universal binary
     if self.target.is_ios():
       builtbin = toolchain.copy(writer, archbins[config], os.path.join(apppath, toolchain.binprefix + binname + toolchain.binext))
     else:
-      builtbin = toolchain.copy(writer, archbins[config], os.path.join(apppath, 'Contents', 'MacOS', toolchain.binprefix + binname + toolchain.binext))
+      builtbin = toolchain.copy(writer, archbins[config], os.path.join(contentpath, 'MacOS', toolchain.binprefix + binname + toolchain.binext))
 
     #Build resources
     if resources:
       has_resources = False
 
-      #Lists of input plists and partial plist files produced by resources
-      plists = []
+      #Lists of partial plist files produced by resources
       assetsplists = []
       xibplists = []
 
       #All resource output files
       outfiles = []
 
-      #First build everything except plist inputs
+      #Group resources by extension in one pass, other resources are not part of the bundle
+      bundleresources = {'xcassets': [], 'xib': [], 'plist': []}
       for resource in resources:
-        if resource.endswith('.xcassets'):
-          if self.target.is_macos():
-            assetsvars = [('outpath', os.path.join(os.getcwd(), apppath, 'Contents', 'Resources'))]
-          else:
-            assetsvars = [('outpath', apppath)]
-          outplist = os.path.join(os.getcwd(), builddir, os.path.splitext(os.path.basename(resource))[0] + '-xcassets.plist')
-          assetsvars += [('outplist', outplist)]
-          outfiles = [outplist]
-          if self.target.is_macos():
-            outfiles += [os.path.join(os.getcwd(), apppath, 'Contents', 'Resources', 'AppIcon.icns')]
-          elif self.target.is_ios():
-            pass #TODO: Need to list all icon and launch image files here
-          assetsplists += writer.build(outfiles, 'xcassets', os.path.join(os.getcwd(), basepath, module, resource), variables = assetsvars)
-          has_resources = True
-        elif resource.endswith('.xib'):
-          xibmodule = binname.replace('-', '_').replace('.', '_')
-          if self.target.is_macos():
-            nibpath = os.path.join(apppath, 'Contents', 'Resources', os.path.splitext(os.path.basename(resource))[0] + '.nib')
-          else:
-            nibpath = os.path.join(apppath, os.path.splitext(os.path.basename(resource))[0] + '.nib')
-          plistpath = os.path.join(builddir, os.path.splitext(os.path.basename(resource))[0] + '-xib.plist')
-          xibplists += [plistpath]
-          outfiles = []
-          if self.target.is_ios():
-            outfiles += [os.path.join(nibpath, 'objects.nib'), os.path.join(nibpath, 'objects-8.0+.nib'), os.path.join(nibpath, 'runtime.nib')]
-          outfiles += [nibpath, plistpath]
-          builtres += writer.build(outfiles, 'xib', os.path.join(basepath, module, resource), variables = [('outpath', nibpath), ('outplist', plistpath), ('module', xibmodule)])
-          has_resources = True
-        elif resource.endswith('.plist'):
-          plists += [os.path.join(basepath, module, resource)]
+        _, dot, extension = resource.rpartition('.')
+        if dot and extension in bundleresources:
+          bundleresources[extension] += [resource]
+
+      #First build everything except plist inputs
+      xibmodule = binname.translate(xibmoduletable)
+      for resource in bundleresources['xib']:
+        resourcename = os.path.splitext(os.path.basename(resource))[0]
+        nibpath = os.path.join(resourcepath, resourcename + '.nib')
+        plistpath = os.path.join(builddir, resourcename + '-xib.plist')
+        xibplists += [plistpath]
+        outfiles = []
+        if self.target.is_ios():
+          outfiles += [os.path.join(nibpath, 'objects.nib'), os.path.join(nibpath, 'objects-8.0+.nib'), os.path.join(nibpath, 'runtime.nib')]
+        outfiles += [nibpath, plistpath]
+        builtres += writer.build(outfiles, 'xib', os.path.join(basepath, module, resource), variables = [('outpath', nibpath), ('outplist', plistpath), ('module', xibmodule)])
+        has_resources = True
+
+      #Asset catalogs are compiled together by a single actool invocation
+      assets = [os.path.join(cwd, basepath, module, resource) for resource in bundleresources['xcassets']]
+      if assets:
+        if self.target.is_macos():
+          assetsvars = [('outpath', os.path.join(cwd, resourcepath))]
+        else:
+          assetsvars = [('outpath', apppath)]
+        outplist = os.path.join(cwd, builddir, binname + '-xcassets.plist')
+        assetsvars += [('outplist', outplist)]
+        outfiles = [outplist]
+        if self.target.is_macos():
+          outfiles += [os.path.join(cwd, resourcepath, 'AppIcon.icns')]
+        elif self.target.is_ios():
+          pass #TODO: Need to list all icon and launch image files here
+        assetsplists += writer.build(outfiles, 'xcassets', assets, variables = assetsvars)
+        has_resources = True
+
+      plists = [os.path.join(basepath, module, resource) for resource in bundleresources['plist']]
 
       #Extra output files/directories
       outfiles = []
       if has_resources and self.target.is_macos():
-        outfiles += [os.path.join(apppath, 'Contents', 'Resources')]
+        outfiles += [resourcepath]
 
       #Now build input plists appending partial plists created by previous resources
-      if self.target.is_macos():
-        plistpath = os.path.join(apppath, 'Contents', 'Info.plist')
-        pkginfopath = os.path.join(apppath, 'Contents', 'PkgInfo')
-      else:
-        plistpath = os.path.join(apppath, 'Info.plist')
-        pkginfopath = os.path.join(apppath, 'PkgInfo')
+      plistpath = os.path.join(contentpath, 'Info.plist')
+      pkginfopath = os.path.join(contentpath, 'PkgInfo')
       plistvars = [('exename', binname), ('prodname', binname), ('outpath', plistpath)]
       bundleidentifier = self.make_bundleidentifier(binname)
       if bundleidentifier != '':
@@ -206,13 +313,15 @@ class XCode(object):
     #Do code signing (might modify binary, but does not matter, nothing should have final binary as input anyway)
     if codesign:
       codesignvars = [('builddir', builddir), ('binname', binname), ('outpath', apppath), ('config', config)]
-      if self.target.is_ios():
-        if self.provisioning != '':
-          codesignvars += [('provisioning', self.provisioning)]
-        writer.build([os.path.join(apppath, '_CodeSignature', 'CodeResources'), os.path.join(apppath, '_CodeSignature'), apppath], 'codesign', builtbin, implicit = builtres + [os.path.join('build', 'ninja', 'codesign.py')], variables = codesignvars)
-      elif self.target.is_macos():
-        if self.provisioning != '':
-          codesignvars += [('provisioning', self.provisioning)]
-        writer.build([os.path.join(apppath, 'Contents', '_CodeSignature', 'CodeResources'), os.path.join(apppath, 'Contents', '_CodeSignature'), os.path.join(apppath, 'Contents'), apppath], 'codesign', builtbin, implicit = builtres + [os.path.join('build', 'ninja', 'codesign.py')], variables = codesignvars)
+      if self.provisioning != '':
+        codesignvars += [('provisioning', self.provisioning)]
+      signaturepath = os.path.join(contentpath, '_CodeSignature')
+      signedfiles = [os.path.join(signaturepath, 'CodeResources'), signaturepath]
+      if self.target.is_macos():
+        if config in ('debug', 'profile'):
+          #Only the executable is signed in development builds, there is no bundle seal so a stamp marks the edge as done
+          signedfiles = [os.path.join(builddir, binname + '.signed')]
+        signedfiles += [contentpath]
+      writer.build(signedfiles + [apppath], 'codesign', builtbin, implicit = builtres + [os.path.join('build', 'ninja', 'codesign.py')], variables = codesignvars)
 
     return builtbin + builtsym + builtres